@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+CocoaProbe against a fake objc runtime.
+
+The runtime functions are ctypes callbacks with the argument types of the
+real ones, so passing text where the runtime takes c strings fails here as
+it does on macOS. The fake knows just enough of NSString, NSAutoreleasePool
+and ScriptingBridge to answer `current_tab` for every browser of the config:
+
+    $ python -m benchmarks.cocoa_probe
+"""
+import sys
+import ctypes
+
+import trackmac.config
+import trackmac.cocoa
+from trackmac.probes import CocoaProbe
+
+TITLE = u'GitHub – Pull requests'
+URL = u'https://github.com/pulls'
+
+
+class FakeObject(object):
+    """
+    Instance of the fake runtime, messages are looked up in `methods` by selector name
+    """
+
+    def __init__(self, runtime, methods, text=None):
+        self.methods = methods
+        # contents of an NSString
+        self.text = text
+        runtime.objects.append(self)
+        self.id = len(runtime.objects)
+
+
+class FakeRuntime(object):
+    """
+    objc_getClass, sel_registerName and objc_msgSend of a handful of classes
+    """
+
+    def __init__(self, bundle_ids):
+        self.objects = []
+        self.selectors = []
+        # c strings handed out by UTF8String, kept alive like autoreleased memory
+        self.buffers = []
+        self.classes = {
+            b'NSString': FakeObject(self, {b'stringWithUTF8String:': self.string}),
+            b'NSAutoreleasePool': FakeObject(self, {b'alloc': lambda param: self.pool()}),
+            b'SBApplication': FakeObject(self, {b'applicationWithBundleIdentifier:': self.application}),
+        }
+        self.bundle_ids = bundle_ids
+        self.objc_getClass = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p)(self.get_class)
+        self.sel_registerName = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p)(self.register_name)
+        self.objc_msgSend = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                             ctypes.c_void_p)(self.msg_send)
+
+    def get_class(self, name):
+        return self.classes[name].id
+
+    def register_name(self, name):
+        if name not in self.selectors:
+            self.selectors.append(name)
+        return self.selectors.index(name) + 1
+
+    def msg_send(self, obj_id, sel_id, param):
+        selector = self.selectors[sel_id - 1]
+        result = self.objects[obj_id - 1].methods[selector](param)
+        return result.id if isinstance(result, FakeObject) else result
+
+    def string(self, address):
+        text = ctypes.string_at(address)
+        buf = ctypes.create_string_buffer(text)
+        self.buffers.append(buf)
+        return FakeObject(self, {b'UTF8String': lambda param: ctypes.addressof(buf)}, text.decode('utf8'))
+
+    def pool(self):
+        pool = FakeObject(self, {b'drain': lambda param: 0})
+        pool.methods[b'init'] = lambda param: pool
+        return pool
+
+    def application(self, address):
+        specifics = self.bundle_ids[self.objects[address - 1].text]
+        tab = FakeObject(self, {
+            specifics['title'].encode('utf8'): lambda param: self.string(self.c_string(TITLE)),
+            specifics['url'].encode('utf8'): lambda param: self.string(self.c_string(URL)),
+        })
+        window = FakeObject(self, {specifics['tab'].encode('utf8'): lambda param: tab})
+        windows = FakeObject(self, {b'count': lambda param: 1, b'objectAtIndex:': lambda param: window})
+        return FakeObject(self, {b'windows': lambda param: windows})
+
+    def c_string(self, text):
+        buf = ctypes.create_string_buffer(text.encode('utf8'))
+        self.buffers.append(buf)
+        return ctypes.addressof(buf)
+
+
+def main():
+    runtime = FakeRuntime(dict((specifics['bundle_id'], specifics)
+                               for specifics in trackmac.config.BROWSERS.values()))
+    trackmac.cocoa.objc_runtime = lambda: runtime
+    failed = False
+    for browser_name in sorted(trackmac.config.BROWSERS):
+        try:
+            tab = CocoaProbe().current_tab(browser_name)
+        except Exception as e:
+            tab = e
+        ok = tab == (TITLE, URL)
+        failed = failed or not ok
+        print(u'{:<14} {}  {!r}'.format(browser_name, 'ok    ' if ok else 'FAILED', tab))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
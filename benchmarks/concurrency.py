@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Run heavy reports in another process while the sampling loop writes.
+
+The loop flushes on every tick, the reader aggregates all raw records in
+a loop on a read-only connection. The check fails if the loop logs a
+database error or loses seconds:
+
+    $ python -m benchmarks.concurrency --days 90 --ticks 5000
+"""
+import os
+import sys
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import multiprocessing
+
+from peewee import fn
+
+from trackmac.app import TimeTracking
+from trackmac.models import db, Application, NormalTrackRecord, WebTrackRecord
+from trackmac.probes import ReplayProbe, VirtualClock
+from benchmarks.history import generate
+
+
+def heavy_reports(path, stop, counter):
+    db.init(path)
+    tt = TimeTracking()
+    while not stop.is_set():
+        with tt.read_only():
+            for model in (NormalTrackRecord, WebTrackRecord):
+                list(model.select(fn.SUM(model.duration), Application.app_name).join(Application).
+                     group_by(Application.app_name).tuples())
+        counter.value += 1
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sampling loop against concurrent reports')
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--ticks', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='trackmac-concurrency-')
+    try:
+        path = os.path.join(workdir, 'track.db')
+        generate(path, days=args.days)
+        db.close()
+
+        stop = multiprocessing.Event()
+        counter = multiprocessing.Value('i', 0)
+        reader = multiprocessing.Process(target=heavy_reports, args=(path, stop, counter))
+        reader.start()
+
+        db.init(path)
+        errors = ErrorCounter()
+        logging.getLogger().addHandler(errors)
+        start = datetime.datetime.now()
+        before = NormalTrackRecord.select(fn.SUM(NormalTrackRecord.duration)).scalar()
+        script = [(10, 'Terminal', None, None), (5, 'PyCharm', None, None)] * (args.ticks // 15)
+        TimeTracking(probe=ReplayProbe.from_script(script), clock=VirtualClock(start), flush_interval=0).start()
+        written = NormalTrackRecord.select(fn.SUM(NormalTrackRecord.duration)).scalar() - before
+
+        stop.set()
+        reader.join()
+    finally:
+        shutil.rmtree(workdir)
+
+    # a session of n ticks lasts n - 1 seconds
+    expected = sum(max(seconds - 1, 1) for seconds, _, _, _ in script)
+    print('{} reports ran while the loop wrote {} sessions'.format(counter.value, len(script)))
+    print('seconds written {}, expected {}, errors logged {}'.format(written, expected, len(errors.records)))
+    if errors.records or written != expected or not counter.value:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic track.db generator.
+
+    $ python -m benchmarks.history /tmp/track.db --days 365
+"""
+import random
+import argparse
+import datetime
+
+from peewee import chunked
+
+import trackmac.utils
+import trackmac.migrations
+from trackmac.models import db, Application, NormalTrackRecord, WebTrackRecord, PageUrl, PageTitle, DailyUsage, \
+    store_longest_record
+
+BROWSER = 'Google Chrome'
+TAGS = ['Developing', 'Studying', 'Playing', 'Reading']
+
+
+def zipf_weights(n, s=1.1):
+    return [1.0 / (i + 1) ** s for i in range(n)]
+
+
+def generate(path, days=365, apps=40, domains=200, sessions=400, web_share=0.4, start=None, seed=1):
+    """
+    write `days` of history into a new database at `path`, `sessions` rows per day.
+    a few apps get tags so grouped reports have something to group.
+    """
+    rnd = random.Random(seed)
+    db.init(path)
+    trackmac.migrations.migrate()
+    start = start or datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=days),
+                                               datetime.time(8))
+    with db.atomic():
+        app_ids = [Application.insert(app_name=u'App {}'.format(i),
+                                      tag_name=TAGS[i % len(TAGS)] if i % 3 == 0 else None).execute()
+                   for i in range(apps)]
+        browser_id = Application.insert(app_name=BROWSER).execute()
+    app_weights = zipf_weights(apps)
+    urls = [u'https://site{}.example.com/page/{}'.format(i, j) for i in range(domains) for j in range(5)]
+    url_weights = zipf_weights(len(urls))
+    with db.atomic():
+        url_ids = dict((url, PageUrl.insert(url=url).execute()) for url in urls)
+        title_ids = dict((url, PageTitle.insert(title=u'Title of {}'.format(url)).execute()) for url in urls)
+    for day in range(days):
+        normal, web = [], []
+        now = start + datetime.timedelta(days=day)
+        for _ in range(sessions):
+            seconds = max(1, int(rnd.lognormvariate(3.5, 1.2)))
+            end = now + datetime.timedelta(seconds=seconds)
+            row = {'start_datetime': now, 'end_datetime': end, 'duration': seconds}
+            if rnd.random() < web_share:
+                url = rnd.choices(urls, url_weights)[0]
+                row.update(app=browser_id, url=url_ids[url], domain=trackmac.utils.url_domain(url),
+                           title=title_ids[url])
+                web.append(row)
+            else:
+                row['app'] = rnd.choices(app_ids, app_weights)[0]
+                normal.append(row)
+            # small gaps like the ones the daemon leaves between sessions
+            now = end + datetime.timedelta(seconds=rnd.choice([0, 1, 2, 30]))
+        with db.atomic():
+            for batch in chunked(normal, 500):
+                NormalTrackRecord.insert_many(batch).execute()
+            for batch in chunked(web, 500):
+                WebTrackRecord.insert_many(batch).execute()
+    DailyUsage.rebuild()
+    for model in (NormalTrackRecord, WebTrackRecord):
+        store_longest_record(model)
+    return start, start + datetime.timedelta(days=days)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic track.db')
+    parser.add_argument('path')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--apps', type=int, default=40)
+    parser.add_argument('--domains', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=400, help='rows per day')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    generate(args.path, args.days, args.apps, args.domains, args.sessions, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
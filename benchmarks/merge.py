@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Merged totals against the totals of the merged databases.
+
+Generates the history of another machine and merges it before and after
+that machine ran `tm compact -k`, into a database that has archived days of
+its own and into a new one. Every merge, and merging the same copy again,
+must report exactly the time the other machine reports for itself:
+
+    $ python -m benchmarks.merge --days 30 --keep 3
+"""
+import os
+import sys
+import shutil
+import argparse
+import datetime
+import tempfile
+
+import trackmac.migrations
+from trackmac.app import TimeTracking
+from trackmac.models import db
+from benchmarks.history import generate
+
+HOST = 'work-mac'
+
+
+def totals(tt, start, end, host=None):
+    return dict(tt.report(start, end, 'app_name', host=host))
+
+
+def run(days, keep, local_keep, workdir):
+    src, dst, fresh = [os.path.join(workdir, name) for name in ('work-mac.db', 'track.db', 'fresh.db')]
+    tt = TimeTracking(report_cache=False)
+    first, _ = generate(src, days=days, sessions=100, seed=2)
+    start, end = first.date(), datetime.date.today() + datetime.timedelta(days=1)
+    expected = totals(tt, start, end)
+    generate(dst, days=days, sessions=100, seed=3)
+    # days archived here, their records of the other machine only go to the daily usage
+    tt.compact(keep_days=local_keep, archive=False)
+    own = totals(tt, start, end, '')
+    results = []
+
+    def check(name, path, merges=2):
+        db.init(path)
+        for i in range(merges):
+            stats = tt.merge(src, HOST)
+            results.append(('{} #{}'.format(name, i + 1), stats,
+                            totals(tt, start, end, HOST) == expected and
+                            (path != dst or totals(tt, start, end, '') == own)))
+        db.close()
+
+    check('uncompacted into archived', dst)
+    db.init(src)
+    tt.compact(keep_days=keep, archive=False)
+    if totals(tt, start, end) != expected:
+        results.append(('compacted source', {}, False))
+    db.close()
+    check('compacted into archived', dst)
+    db.init(fresh)
+    trackmac.migrations.migrate()
+    db.close()
+    check('compacted into new', fresh)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check merged totals, also of compacted databases')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--keep', type=int, default=3, help='days the merged machine keeps records of')
+    parser.add_argument('--local-keep', type=int, default=10, help='days the merging machine keeps records of')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='trackmac-merge-')
+    try:
+        results = run(args.days, args.keep, args.local_keep, workdir)
+    finally:
+        db.close()
+        shutil.rmtree(workdir)
+    for name, stats, ok in results:
+        print('{:<28} {}  {}'.format(name, 'ok    ' if ok else 'FAILED',
+                                     ', '.join('{} {}'.format(k, v) for k, v in sorted(stats.items()))))
+    if not all(ok for _, _, ok in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Time the report paths, with and without tag rules, `block` and `add_tag`
+against synthetic histories.
+
+Every size gets its own database in a temporary directory, ~/Library is
+never touched. Results are written as json so runs of different versions
+can be compared:
+
+    $ python -m benchmarks.reports --days 30 365 -o bench.json
+
+The `edges` cases read records only, they take about as long at 730 days
+as at 30.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+
+from playhouse.test_utils import count_queries
+
+import trackmac.config
+from trackmac.app import TimeTracking
+from trackmac.models import db
+from benchmarks.history import generate
+
+PERIODS = [('day', 1), ('week', 7), ('month', 30), ('year', 365)]
+
+
+def measure(func, repeat=5, setup=None):
+    """
+    best wall time, statements executed and peak python memory of func().
+    `setup` runs before every call, e.g. to restore the data func changes.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    if setup:
+        setup()
+    with count_queries() as counter:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'seconds': min(timings), 'queries': counter.count, 'peak_bytes': peak}
+
+
+def report_cases(tt, end):
+    for period, days in PERIODS:
+        start = end - datetime.timedelta(days=days)
+        # -n 10 is the default of `tm list`
+        yield 'list {}'.format(period), lambda: tt.report(start, end, 'app_name', 10)
+        yield 'list web {}'.format(period), lambda: tt.web_report(start, end, 10)
+        yield 'list web -n 1000 {}'.format(period), lambda: tt.web_report(start, end, 1000)
+        yield 'list -T {}'.format(period), lambda: tt.report(start, end, 'tag_name', 10)
+
+
+def edge_cases(tt, end):
+    """
+    ranges starting and ending within a day, the records of the partial days are read.
+    their cost should not grow with the history before them.
+    """
+    start = end - datetime.timedelta(days=1, hours=-9)
+    stop = end - datetime.timedelta(hours=7)
+    yield 'list edges', lambda: tt.report(start, stop, 'app_name', 10)
+    yield 'list web edges', lambda: tt.web_report(start, stop, 10)
+    yield 'heatmap edges', lambda: tt.heatmap(start, stop)
+    week = datetime.timedelta(days=7)
+    yield 'compare edges', lambda: tt.compare([(start - week, stop - week), (start, stop)])
+
+
+def rule_cases(tt, end, rules):
+    """
+    reports by tag after adding `rules` rules, half for applications and half for web sites
+    """
+    for i in range(rules):
+        if i % 2:
+            tt.add_tag_rule('Rule {}'.format(i), 'site{}.example.*'.format(i), 'domain')
+        else:
+            tt.add_tag_rule('Rule {}'.format(i), r'^App {}$'.format(i), regex=True)
+    for period, days in PERIODS:
+        start = end - datetime.timedelta(days=days)
+        yield 'list -T {} {} rules'.format(period, rules), lambda: tt.report(start, end, 'tag_name', 10)
+        yield 'list web -T {} {} rules'.format(period, rules), lambda: tt.web_report(start, end, 10, tags=True)
+
+
+def run(days, sessions, apps, domains, rules, workdir, repeat):
+    path = os.path.join(workdir, 'track-{}.db'.format(days))
+    started = time.perf_counter()
+    first, last = generate(path, days=days, apps=apps, domains=domains, sessions=sessions)
+    results = {
+        'days': days,
+        'rows': days * sessions,
+        'generate_seconds': time.perf_counter() - started,
+        'db_bytes': os.path.getsize(path),
+        'cases': {},
+    }
+    tt = TimeTracking(report_cache=False)
+    end = datetime.datetime.combine(last.date(), datetime.time())
+    for name, func in report_cases(tt, end):
+        results['cases'][name] = measure(func, repeat)
+    for name, func in edge_cases(tt, end):
+        results['cases'][name] = measure(func, repeat)
+    # closed days, served from the report cache after the first run
+    cached = TimeTracking()
+    for name, func in report_cases(cached, end):
+        results['cases'][name + ' cached'] = measure(func, repeat)
+    for name, func in rule_cases(tt, end, rules):
+        results['cases'][name] = measure(func, repeat)
+    results['cases']['tag -a'] = measure(lambda: tt.add_tag('Benchmark', 'App 1'), repeat)
+    # block deletes records, so every call gets a fresh copy
+    copy = path + '.block'
+    # in WAL mode recent pages are still in the -wal file, move them into the database first
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def fresh_copy():
+        db.close()
+        shutil.copy(path, copy)
+        db.init(copy)
+
+    results['cases']['block'] = measure(lambda: tt.block('App 0'), repeat, setup=fresh_copy)
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark trackmac reports')
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 30, 365])
+    parser.add_argument('--sessions', type=int, default=400, help='rows per day')
+    parser.add_argument('--apps', type=int, default=40)
+    parser.add_argument('--domains', type=int, default=200)
+    parser.add_argument('--rules', type=int, default=200, help='tag rules of the tagged report cases')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('-o', '--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='trackmac-bench-')
+    try:
+        runs = []
+        for days in args.days:
+            runs.append(run(days, args.sessions, args.apps, args.domains, args.rules, workdir, args.repeat))
+            db.close()
+            sys.stderr.write('{} days done\n'.format(days))
+    finally:
+        shutil.rmtree(workdir)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'version': trackmac.config.VERSION,
+            'python': platform.python_version(),
+            'sqlite': db.server_version and '.'.join(str(v) for v in db.server_version),
+            'created': datetime.datetime.now().isoformat(),
+            'runs': runs,
+        }, f, indent=2)
+    sys.stderr.write('written to {}\n'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling loop against a browser slower than the probe timeout.
+
+Replays a short script on the system clock where every `current_tab` call
+blocks for `--latency` seconds, longer than `--timeout` but shorter than a
+tick. Every browser tick must then stall exactly once and still take about
+`--timeout` seconds, ticks must keep their cadence without missing any, and
+every tab must end up as one unbroken record:
+
+    $ python -m benchmarks.slow_probe --interval 0.2 --timeout 0.05 --latency 0.15
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import trackmac.config
+import trackmac.migrations
+from trackmac.app import TimeTracking
+from trackmac.models import db, NormalTrackRecord, WebTrackRecord
+from trackmac.probes import ReplayProbe, SystemClock
+
+# (ticks, app, title, url), every tab is visited once
+SCRIPT = [
+    (5, 'PyCharm', None, None),
+    (10, 'Google Chrome', 'GitHub', 'https://github.com/'),
+    (10, 'Google Chrome', 'Pull requests', 'https://github.com/pulls'),
+    (5, 'Terminal', None, None),
+    (10, 'Safari', 'Hacker News', 'https://news.ycombinator.com/'),
+    (5, 'PyCharm', None, None),
+]
+
+
+class TimingTracker(TimeTracking):
+    """
+    TimeTracking keeping the start and the length of every tick
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimingTracker, self).__init__(*args, **kwargs)
+        self.ticks = []
+
+    def track(self, buf):
+        started = self.clock.monotonic()
+        try:
+            super(TimingTracker, self).track(buf)
+        finally:
+            self.ticks.append((started, self.clock.monotonic() - started))
+
+
+def run(interval, timeout, latency):
+    workdir = tempfile.mkdtemp(prefix='trackmac-slow-probe-')
+    try:
+        db.init(os.path.join(workdir, 'track.db'))
+        trackmac.migrations.migrate()
+        tracker = TimingTracker(probe=ReplayProbe.from_script(SCRIPT, tab_latency=latency),
+                                probe_timeout=timeout, clock=SystemClock(), interval=interval)
+        tracker.start()
+        records = {
+            'apps': [r.app.app_name for r in NormalTrackRecord.select().order_by(NormalTrackRecord.id)],
+            'tabs': [r.url.url for r in WebTrackRecord.select().order_by(WebTrackRecord.id)],
+        }
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+    return tracker, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tick cadence and sessions with a browser slower than the timeout')
+    parser.add_argument('--interval', type=float, default=0.2, help='seconds between two ticks')
+    parser.add_argument('--timeout', type=float, default=0.05, help='probe timeout')
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds every current_tab call blocks')
+    args = parser.parse_args()
+
+    tracker, records = run(args.interval, args.timeout, args.latency)
+    ticks = tracker.ticks
+    browser_ticks = sum(seconds for seconds, app, _, _ in SCRIPT if app in trackmac.config.BROWSERS)
+    # the exhausted probe ends the loop on an extra tick
+    elapsed = ticks[-1][0] - ticks[0][0]
+    checks = [
+        ('ticks', len(ticks), sum(seconds for seconds, _, _, _ in SCRIPT) + 1),
+        ('missed ticks', tracker.missed_ticks, 0),
+        ('probe stalls', getattr(tracker.probe, 'stalls', 0), browser_ticks),
+        ('slowest tick within the timeout', max(seconds for _, seconds in ticks) < args.timeout + args.interval / 2,
+         True),
+        ('cadence', abs(elapsed - (len(ticks) - 1) * args.interval) < args.interval / 2, True),
+        ('application records', records['apps'], [app for _, app, _, url in SCRIPT if not url]),
+        ('tab records', records['tabs'], [url for _, _, _, url in SCRIPT if url]),
+    ]
+    failed = False
+    for name, value, expected in checks:
+        ok = value == expected
+        failed = failed or not ok
+        print('{:<32} {}  {!r}'.format(name, 'ok    ' if ok else 'FAILED', value))
+    print('{} ticks in {:.2f}s, slowest {:.3f}s'.format(len(ticks), elapsed, max(seconds for _, seconds in ticks)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Import time of the command line tool.
+
+Each sample runs a fresh interpreter, so module caches do not hide the cost:
+
+    $ python -m benchmarks.startup -n 20
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+CASES = [
+    ('python', 'pass'),
+    ('import trackmac.main', 'import trackmac.main'),
+    ('tm --version', 'import sys; sys.argv = ["tm", "--version"]\n'
+                     'import trackmac.main\n'
+                     'try:\n    trackmac.main.cli()\nexcept SystemExit:\n    pass'),
+]
+
+# modules `tm --version` and `tm help` should not need
+HEAVY_MODULES = ['peewee', 'trackmac.models', 'trackmac.app', 'trackmac.cocoa']
+
+TIMER = 'import time; _t = time.perf_counter()\n{}\nimport sys; sys.stderr.write("%f" % (time.perf_counter() - _t))'
+
+
+def sample(code):
+    proc = subprocess.run([sys.executable, '-c', TIMER.format(code)],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    return float(proc.stderr.decode().strip().splitlines()[-1])
+
+
+def loaded_modules():
+    code = 'import trackmac.main, sys; print(" ".join(sorted(sys.modules)))'
+    out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True).stdout.decode()
+    return [name for name in HEAVY_MODULES if name in out.split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the import time of trackmac.main')
+    parser.add_argument('-n', '--number', type=int, default=10)
+    parser.add_argument('-o', '--output', help='write the results as json')
+    args = parser.parse_args()
+
+    results = {'cases': {}, 'heavy_modules_loaded': loaded_modules()}
+    for name, code in CASES:
+        timings = sorted(sample(code) for _ in range(args.number))
+        results['cases'][name] = {'median': timings[len(timings) // 2], 'best': timings[0]}
+        print('{:<22} median {:7.1f} ms  best {:7.1f} ms'.format(
+            name, timings[len(timings) // 2] * 1000, timings[0] * 1000))
+    print('heavy modules loaded by import trackmac.main: {}'.format(
+        ', '.join(results['heavy_modules_loaded']) or 'none'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+SQL run per tick of the sampling loop.
+
+Replays scripted switches between applications and browser tabs against
+a temporary database and counts the statements executed and transactions
+committed on every tick. A tick within a session only asks for
+`PRAGMA data_version`, writes happen on switches and every flush interval.
+The check fails when the steady state, i.e. all ticks after the first pass
+through the script, exceeds the budget:
+
+    $ python -m benchmarks.ticks --cycles 50 --statements 1.25 --worst 8
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import datetime
+import tempfile
+
+import trackmac.migrations
+from trackmac.app import TimeTracking
+from trackmac.models import db, BlockedApplication, TrackState
+from trackmac.probes import ReplayProbe, VirtualClock
+
+# (seconds, app, title, url) of one pass, QQ is blocked
+SCRIPT = [
+    (45, 'PyCharm', None, None),
+    (20, 'Google Chrome', 'GitHub', 'https://github.com/'),
+    (15, 'Google Chrome', 'Pull requests', 'https://github.com/pulls'),
+    (5, 'Terminal', None, None),
+    (3, 'QQ', None, None),
+    (90, 'PyCharm', None, None),
+    (30, 'Safari', 'Hacker News', 'https://news.ycombinator.com/'),
+    (12, 'Google Chrome', 'GitHub', 'https://github.com/'),
+]
+
+
+class CountingTracker(TimeTracking):
+    """
+    TimeTracking keeping the statements and commits of every tick
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingTracker, self).__init__(*args, **kwargs)
+        self.ticks = []
+
+    def track(self, buf):
+        statements, commits = db.statements, db.commits
+        super(CountingTracker, self).track(buf)
+        self.ticks.append((db.statements - statements, db.commits - commits))
+
+
+def run(cycles, flush_interval, metrics):
+    workdir = tempfile.mkdtemp(prefix='trackmac-ticks-')
+    try:
+        db.init(os.path.join(workdir, 'track.db'))
+        trackmac.migrations.migrate()
+        BlockedApplication.create(name='QQ')
+        TrackState.set_value('metrics', int(metrics))
+        tracker = CountingTracker(probe=ReplayProbe.from_script(SCRIPT * cycles),
+                                  clock=VirtualClock(datetime.datetime(2016, 9, 1, 9)),
+                                  flush_interval=flush_interval)
+        tracker.start()
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+    return tracker.ticks
+
+
+def summary(ticks):
+    statements = [s for s, _ in ticks]
+    commits = [c for _, c in ticks]
+    return {
+        'ticks': len(ticks),
+        'statements_per_tick': sum(statements) / float(len(ticks)),
+        'commits_per_tick': sum(commits) / float(len(ticks)),
+        'worst_tick_statements': max(statements),
+        'quiet_ticks': statements.count(min(statements)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='statements and commits per tick of the sampling loop')
+    parser.add_argument('--cycles', type=int, default=50, help='passes through the script')
+    parser.add_argument('--flush-interval', type=int, default=60)
+    parser.add_argument('--no-metrics', dest='metrics', action='store_false')
+    parser.add_argument('--statements', type=float, default=1.25,
+                        help='budget of statements per steady state tick on average')
+    parser.add_argument('--commits', type=float, default=0.05,
+                        help='budget of commits per steady state tick on average')
+    parser.add_argument('--worst', type=int, default=8, help='budget of statements of a single tick')
+    parser.add_argument('-o', '--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    ticks = run(args.cycles, args.flush_interval, args.metrics)
+    warmup = sum(int(seconds) for seconds, _, _, _ in SCRIPT)
+    results = {'warmup': summary(ticks[:warmup]), 'steady': summary(ticks[warmup:])}
+    for phase in ('warmup', 'steady'):
+        r = results[phase]
+        print('{:<7} {ticks:>6} ticks  {statements_per_tick:6.3f} statements  {commits_per_tick:6.3f} commits '
+              'per tick, worst tick {worst_tick_statements} statements'.format(phase, **r))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    steady = results['steady']
+    over = [(name, steady[key], budget) for name, key, budget in [
+        ('statements per tick', 'statements_per_tick', args.statements),
+        ('commits per tick', 'commits_per_tick', args.commits),
+        ('statements of the worst tick', 'worst_tick_statements', args.worst),
+    ] if steady[key] > budget]
+    for name, value, budget in over:
+        print('over budget: {} {:g} > {:g}'.format(name, value, budget))
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import time
+import os
+import re
+import gzip
+import json
+import heapq
+import signal
 import logging
+import operator
 import datetime
+import functools
+import collections
 
 from peewee import *
 
 import trackmac.config
-import trackmac.cocoa
-from trackmac.models import Application, NormalTrackRecord, WebTrackRecord, BlockedApplication
+import trackmac.utils
+import trackmac.models
+import trackmac.metrics
+import trackmac.tagging
+from trackmac.metrics import timer
+from trackmac.models import db, Application, NormalTrackRecord, WebTrackRecord, BlockedApplication, DailyUsage, \
+    PageUrl, PageTitle, TrackState, TagRule, ReportCache, OPEN_RECORD_KEYS, LONGEST_RECORD_KEY
+from trackmac.probes import CocoaProbe, TimedProbe, SystemClock, ProbeExhausted
+from trackmac.session import SessionBuffer
+from trackmac.tagging import TagMatcher
+
+# a line of a report, the name is None for applications without a tag
+ReportRow = collections.namedtuple('ReportRow', ['name', 'duration'])
+CompareRow = collections.namedtuple('CompareRow', ['name', 'durations'])
+# a session of the timeline, `sessions` > 1 for short sessions coalesced into one row
+TimelineRow = collections.namedtuple('TimelineRow', ['start', 'end', 'duration', 'app_name', 'title', 'domain',
+                                                     'sessions'])
+SearchRow = collections.namedtuple('SearchRow', ['url', 'title', 'duration', 'first', 'last', 'visits'])
 
 
 class TimeTracking(object):
@@ -16,85 +40,918 @@ class TimeTracking(object):
         """
         basic config
         """
+        self.flush_interval = kwargs.get('flush_interval', trackmac.config.FLUSH_INTERVAL)
+        self.probe = kwargs.get('probe') or CocoaProbe()
+        # only the desktop gets a deadline by default, replayed samples come at once
+        probe_timeout = kwargs.get('probe_timeout', None if kwargs.get('probe') else trackmac.config.PROBE_TIMEOUT)
+        if probe_timeout:
+            self.probe = TimedProbe(self.probe, probe_timeout)
+        self.clock = kwargs.get('clock') or SystemClock()
+        # seconds between two samples
+        self.interval = kwargs.get('interval', 1)
+        # ticks skipped because a tick took longer than the interval
+        self.missed_ticks = 0
+        # True or False to override the `metrics` state set by `tm stats --on/--off`
+        self.metrics_enabled = kwargs.get('metrics')
+        self.metrics = None
+        # catalog cached by the daemon, reloaded when another process commits
+        self._app_ids = {}
+        self._blocked = set()
+        self._data_version = None
+        # (gap, keep_days) set by `tm compact --auto`, None if the daemon does not compact
+        self._auto_compact = None
+        self._last_compact = None
+        # TagMatcher of the tag rules and the generation it was loaded at
+        self._tag_matcher = None
+        self._tag_generation = None
+        # serve reports over closed days from the report cache
+        self.report_cache = kwargs.get('report_cache', True)
 
     def start(self):
         """
         Start tracking active application or active browser tab in while loop
         """
-        with trackmac.cocoa.NSAutoreleasePool():
-            while True:
-                try:
-                    app_name = trackmac.cocoa.frontmost_application()
-                    if app_name and app_name.decode('utf8') not in self.black_list:
-                        cur_app, created = Application.get_or_create(app_name=app_name)
-                        if app_name not in trackmac.config.BROWSERS.keys():
-                            WebTrackRecord.update(is_current=False).where(WebTrackRecord.is_current == True).execute()
-                            record_set = NormalTrackRecord.select().where(NormalTrackRecord.is_current == True)
-                            if record_set.exists():
-                                old_rec = record_set[0]
-                                now = datetime.datetime.now()
-                                # time delay or stopped for some time (1.5s is very inaccurate.)
-                                if old_rec.app != cur_app or (now - old_rec.end_datetime).total_seconds() > 1.5:
-                                    old_rec.is_current = False
-                                    NormalTrackRecord(app=cur_app).save()
-                                else:
-                                    old_rec.end_datetime = now
-                                    old_rec.duration = (old_rec.end_datetime - old_rec.start_datetime).total_seconds()
-                                old_rec.save()
-                            else:
-                                NormalTrackRecord(app=cur_app).save()
-                        else:
-                            NormalTrackRecord.update(is_current=False).where(NormalTrackRecord.is_current == True).execute()
-                            title, url = trackmac.cocoa.current_tab(app_name)
-                            # title can be null
-                            if url:
-                                record_set = WebTrackRecord.select().where(WebTrackRecord.is_current == True)
-                                if record_set.exists():
-                                    old_rec = record_set[0]
-                                    old_rec.end_datetime = datetime.datetime.now()
-                                    old_rec.duration = (old_rec.end_datetime - old_rec.start_datetime).total_seconds()
-                                    if old_rec.url != url:
-                                        old_rec.is_current = False
-                                        WebTrackRecord(app=cur_app, url=url, title=title).save()
-                                    else:
-                                        # sometime web pages not loaded at start due to network lag
-                                        old_rec.title = title
-                                    old_rec.save()
-                                else:
-                                    WebTrackRecord(app=cur_app, url=url, title=title).save()
-                        time.sleep(1)
-                except Exception as e:
-                    logging.exception("Error occurred")
-                    # normally exiting while loop
-                    break
-
-    def report(self, start, end, group_by_field):
-        """
-        get all application records from start to end group by `app_name` or `tag_name`
-        """
-        group_by_field = getattr(Application, group_by_field)
-        records_n = NormalTrackRecord.select(fn.SUM(NormalTrackRecord.duration).alias('duration'), group_by_field). \
-            where((NormalTrackRecord.start_datetime >= start) & (NormalTrackRecord.start_datetime <= end)).join(
-            Application).group_by(group_by_field).dicts()
-        records_w = WebTrackRecord.select(fn.SUM(WebTrackRecord.duration).alias('duration'), group_by_field). \
-            where((WebTrackRecord.start_datetime >= start) & (WebTrackRecord.start_datetime <= end)).join(
-            Application).group_by(group_by_field).dicts()
-        rec_list = [r for r in records_n] + [r for r in records_w]
-        # It's weird
-        # map(lambda x:x.update({'duration':int((x['duration']-datetime.datetime.fromtimestamp(0)). \
-        # total_seconds())}), rec_list)
-        return rec_list
-
-    def web_report(self, start, end):
-        """
-        get all web browsing records from start to end group by url's domain name
-        """
-        records = WebTrackRecord.select(fn.SUM(WebTrackRecord.duration).alias('duration'),
-                                        fn.Substr(WebTrackRecord.url, 1, fn.Instr(
-                                            fn.Substr(WebTrackRecord.url, 9), '/') + 8).alias('domain')). \
-            where((WebTrackRecord.start_datetime >= start) & (WebTrackRecord.start_datetime <= end)).join(
-            Application).group_by(SQL('domain')).order_by(WebTrackRecord.duration.desc()).dicts()
-        return records
+        buf = SessionBuffer(self.flush_interval, gap=1.5 * self.interval)
+        buf.resume(self.clock.now())
+        with self.probe:
+            try:
+                next_tick = self.clock.monotonic()
+                while True:
+                    # set by the first tick or `tm stats --on/--off`
+                    metrics = buf.metrics = self.metrics
+                    if metrics:
+                        started, statements = timer(), db.statements
+                    try:
+                        self.track(buf)
+                    except ProbeExhausted:
+                        break
+                    except OperationalError:
+                        # e.g. database is locked, the session buffer retries on the next tick
+                        logging.warning("Database not available", exc_info=True)
+                        if metrics:
+                            metrics.count('db_errors')
+                    except Exception as e:
+                        logging.exception("Error occurred")
+                        # normally exiting while loop
+                        break
+                    if metrics:
+                        metrics.count('ticks')
+                        metrics.observe('tick_seconds', timer() - started)
+                        metrics.observe('statements_per_tick', db.statements - statements)
+                        if metrics.due():
+                            self.write_metrics()
+                    # ticks start at a fixed cadence however long the tick took
+                    next_tick += self.interval
+                    delay = next_tick - self.clock.monotonic()
+                    if delay < 0:
+                        # too late, skip the missed ticks instead of running them in a burst
+                        missed = int(-delay // self.interval) + 1
+                        self.missed_ticks += missed
+                        next_tick += missed * self.interval
+                        delay += missed * self.interval
+                    self.clock.sleep(delay)
+            finally:
+                buf.close()
+                buf.flush(self.clock.now())
+                if self.metrics:
+                    self.write_metrics()
+
+    def write_metrics(self):
+        self.metrics.write({
+            'missed_ticks': self.missed_ticks,
+            'probe_stalls': getattr(self.probe, 'stalls', 0),
+            'statements': db.statements,
+            'commits': db.commits,
+        }, db.database)
+
+    def track(self, buf):
+        """
+        take one sample of the frontmost application and feed it to the session buffer
+        """
+        # the time of the tick, however long probing takes
+        now = self.clock.now()
+        metrics = self.metrics
+        if metrics:
+            probe_started = timer()
+        app_name = self.probe.frontmost_application()
+        if metrics:
+            metrics.observe('probe_seconds', timer() - probe_started)
+        if not app_name:
+            return
+        if self.reload_catalog():
+            # records of blocked applications have just been deleted
+            buf.forget(set(self._app_ids.values()))
+        if app_name in trackmac.config.IDLE_APPLICATIONS and self._auto_compact:
+            self.auto_compact(buf)
+        if app_name in self._blocked:
+            return
+        app_id = self.app_id(app_name)
+        if app_name not in trackmac.config.BROWSERS.keys():
+            buf.track(now, app_id)
+        else:
+            if metrics:
+                probe_started = timer()
+            title, url = self.probe.current_tab(app_name)
+            if metrics:
+                metrics.observe('tab_seconds', timer() - probe_started)
+            # title can be null
+            if url:
+                buf.track(now, app_id, url, title)
+
+    def reload_catalog(self):
+        """
+        reload cached application ids and block list if another connection changed the database,
+        `PRAGMA data_version` only changes on commits made by other connections.
+        """
+        data_version = db.pragma('data_version')
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        # the first row wins if an application name is stored twice
+        self._app_ids = dict(Application.select(Application.app_name, Application.id).
+                             order_by(Application.id.desc()).tuples())
+        self._blocked = set(self.black_list)
+        enabled = self.metrics_enabled
+        if enabled is None:
+            enabled = TrackState.get_value('metrics', 0)
+        if not enabled:
+            self.metrics = None
+        elif self.metrics is None:
+            self.metrics = trackmac.metrics.Metrics(trackmac.models.metrics_file(), trackmac.config.METRICS_INTERVAL)
+        gap = TrackState.get_value('auto_compact_gap')
+        self._auto_compact = gap is not None and (gap, TrackState.get_value('auto_compact_keep_days'))
+        return True
+
+    def auto_compact(self, buf):
+        """
+        compact while the user is away, at most once every COMPACT_INTERVAL seconds
+        """
+        now = self.clock.now()
+        if self._last_compact and (now - self._last_compact).total_seconds() < trackmac.config.COMPACT_INTERVAL:
+            return
+        self._last_compact = now
+        # closed sessions are written first, the open record is never touched
+        buf.flush(now)
+        # ids of archived urls and titles are deleted
+        buf.urls.clear()
+        buf.titles.clear()
+        gap, keep_days = self._auto_compact
+        try:
+            stats = self.compact(gap, keep_days, full_vacuum=False, max_days=trackmac.config.COMPACT_DAYS)
+        except Exception:
+            # tracking goes on, compaction is tried again after the next interval
+            logging.exception("Compaction failed")
+            return
+        logging.info("Compacted: {merged} records merged, {archived} archived, {freed} bytes freed".format(**stats))
+        if stats['more']:
+            # a long backlog, e.g. on the first run, goes on a few days per tick while the user is away
+            self._last_compact = None
+
+    def app_id(self, app_name):
+        """
+        cached id of the application, created on first sight
+        """
+        if app_name not in self._app_ids:
+            app, created = Application.get_or_create(app_name=app_name)
+            self._app_ids[app_name] = app.id
+        return self._app_ids[app_name]
+
+    def report(self, start, end, group_by_field, limit=None, host=None):
+        """
+        time spent per `app_name`, `tag_name` or `host` from start to end, longest first.
+        only the records of the given host if any, '' is this machine. tags come from the tag rules too.
+        """
+        return self._report(group_by_field, start, end, limit, host)
+
+    def web_report(self, start, end, limit=None, host=None, tags=False):
+        """
+        time spent per web site (scheme and host of the url) from start to end, longest first.
+        per tag of the web sites and browsers if `tags`.
+        """
+        return self._report('domain_tag' if tags else 'domain', start, end, limit, host)
+
+    def _report(self, group, start, end, limit, host=None):
+        """
+        closed days come from the report cache, only the time after them is queried
+        """
+        start, end = trackmac.utils.as_datetime(start), trackmac.utils.as_datetime(end)
+        split = min(end, self._closed_until()) if self.report_cache else start
+        if split <= start:
+            return self._aggregate(self._report_parts(group, start, end, host), limit)
+        totals = dict(self._closed_report(group, start, split, host))
+        if split < end:
+            for name, seconds in self._aggregate(self._report_parts(group, split, end, host)):
+                totals[name] = totals.get(name, 0) + seconds
+        rows = sorted((ReportRow(name, seconds) for name, seconds in totals.items() if seconds > 0),
+                      key=lambda row: (-row.duration, row.name or ''))
+        return rows[:limit] if limit else rows
+
+    def compare(self, ranges, group_by_field='app_name', limit=None, host=None):
+        """
+        time spent per `app_name`, `tag_name`, `domain` or `host` in each of the (start, end) ranges, biggest
+        change between the first and the last range first. all ranges are added up in one query with a
+        conditional sum per range, whole days come from the daily rollup like in `report`.
+        """
+        parts = []
+        for i, (start, end) in enumerate(ranges):
+            start, end = trackmac.utils.as_datetime(start), trackmac.utils.as_datetime(end)
+            parts += [part.select_extend(Value(i).alias('period'))
+                      for part in self._report_parts(group_by_field, start, end, host)]
+        if not parts:
+            return []
+        union = functools.reduce(operator.add, parts)
+        sums = [fn.SUM(Case(None, [(union.c.period == i, union.c.seconds)], 0)) for i in range(len(ranges))]
+        query = union.select_from(union.c.name, *sums).group_by(union.c.name).\
+            having(fn.SUM(union.c.seconds) > 0).order_by(fn.ABS(sums[-1] - sums[0]).desc(), union.c.name)
+        if limit:
+            query = query.limit(limit)
+        return [CompareRow(row[0], list(row[1:])) for row in query.tuples()]
+
+    def heatmap(self, start, end, app_name=None, tag_name=None, domain=None, host=None):
+        """
+        seconds spent per weekday (monday first) and hour of the day from start to end as 7 lists of 24,
+        only for the given application, tag, web site or host if any. records running into the next hour
+        are split at the hour by a recursive query, so the hours add up to the report of the range.
+        """
+        start, end = trackmac.utils.as_datetime(start), trackmac.utils.as_datetime(end)
+        first, last = start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')
+        parts = []
+        for model in (WebTrackRecord,) if domain is not None else (NormalTrackRecord, WebTrackRecord):
+            query = model.select(model.start_datetime, model.end_datetime, model.duration,
+                                 fn.strftime('%Y-%m-%d %H:00:00', fn.MAX(model.start_datetime, first)).alias('hour')).\
+                where(trackmac.models.overlapping(model, start, end))
+            if app_name is not None or tag_name is not None:
+                query = query.join(Application)
+                if app_name is not None:
+                    query = query.where(Application.app_name == app_name)
+                if tag_name is not None:
+                    domain_field = model.domain if model is WebTrackRecord else Value('')
+                    query = query.where(self._tag_field(domain_field) == tag_name)
+            if domain is not None:
+                query = query.where(model.domain == domain)
+            if host is not None:
+                query = query.where(model.host == host)
+            parts.append(query)
+        union = functools.reduce(operator.add, parts)
+        # one row per record and hour it ran in
+        hours = union.select_from(union.c.start_datetime, union.c.end_datetime, union.c.duration, union.c.hour).\
+            cte('hours', recursive=True, columns=('start_datetime', 'end_datetime', 'duration', 'hour'))
+        next_hour = fn.datetime(hours.c.hour, '+1 hour')
+        hours = hours.union_all(Select((hours,), (hours.c.start_datetime, hours.c.end_datetime, hours.c.duration,
+                                                  next_hour)).
+                                where((next_hour < hours.c.end_datetime) & (next_hour < last)))
+        seconds = trackmac.models.seconds_before(hours.c, fn.MIN(next_hour, last)) - \
+            trackmac.models.seconds_before(hours.c, fn.MAX(hours.c.hour, first))
+        weekday, hour = fn.strftime('%w', hours.c.hour), fn.strftime('%H', hours.c.hour)
+        grid = [[0] * 24 for _ in range(7)]
+        for day, hour_of_day, total in hours.select_from(weekday, hour, fn.SUM(seconds)).group_by(weekday, hour).\
+                tuples():
+            # sqlite counts the days of the week from sunday
+            grid[(int(day) + 6) % 7][int(hour_of_day)] = total
+        return grid
+
+    def timeline(self, day, shorter_than=None, host=''):
+        """
+        yield the sessions of the day, the one running at midnight included, in time order as `TimelineRow`s.
+        both tables are read through cursors ordered by start and merged like in `merge_sessions`, so rows
+        come at once and memory stays flat however busy the day was. consecutive sessions shorter than
+        `shorter_than` seconds are coalesced into one row named after the application they spent the most on.
+        """
+        start = datetime.datetime.combine(day, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        cursors = [self._timeline_cursor(model, i, start, end, host)
+                   for i, model in enumerate((NormalTrackRecord, WebTrackRecord))]
+        rows = (TimelineRow(rec_start, rec_end, duration, app_name, title, domain or None, 1)
+                for rec_start, _, _, rec_end, duration, app_name, title, domain in heapq.merge(*cursors))
+        return self._coalesce(rows, shorter_than) if shorter_than else rows
+
+    @staticmethod
+    def _timeline_cursor(model, table, start, end, host):
+        """
+        (start, table, id, end, duration, app name, title, domain) of the records running from start to end in
+        start order, the record started last before start is the only earlier one which can run past it.
+        """
+        if model is WebTrackRecord:
+            fields = [PageTitle.title, model.domain]
+        else:
+            fields = [Value(None), Value(None)]
+        query = model.select(model.start_datetime, Value(table), model.id, model.end_datetime, model.duration,
+                             Application.app_name, *fields).join(Application)
+        if model is WebTrackRecord:
+            query = query.switch(model).join(PageTitle, JOIN.LEFT_OUTER)
+        query = query.where(model.host == host)
+        previous = query.where(model.start_datetime < start).order_by(model.start_datetime.desc()).limit(1).tuples()
+        for row in previous:
+            if row[3] > start:
+                yield row
+        for row in query.where((model.start_datetime >= start) & (model.start_datetime < end)).\
+                order_by(model.start_datetime, model.id).tuples().iterator():
+            yield row
+
+    @staticmethod
+    def _coalesce(rows, shorter_than):
+        """
+        coalesce runs of rows shorter than `shorter_than` seconds, a single short row is left as it is
+        """
+        run = None
+        for row in rows:
+            if row.duration < shorter_than:
+                if run is None:
+                    run = {'first': row, 'end': row.end, 'sessions': 0, 'apps': collections.Counter()}
+                run['end'] = row.end
+                run['sessions'] += 1
+                run['apps'][row.app_name] += row.duration
+                continue
+            if run is not None:
+                yield TimeTracking._run_row(run)
+                run = None
+            yield row
+        if run is not None:
+            yield TimeTracking._run_row(run)
+
+    @staticmethod
+    def _run_row(run):
+        if run['sessions'] == 1:
+            return run['first']
+        return TimelineRow(run['first'].start, run['end'], sum(run['apps'].values()),
+                           run['apps'].most_common(1)[0][0], None, None, run['sessions'])
+
+    def live_report(self, group, start, end, host=None):
+        """
+        report like `report` and `web_report` kept up to date by `LiveReport.refresh`
+        """
+        return LiveReport(self, group, start, end, host)
+
+    def _closed_until(self):
+        """
+        days before this one do not change any more, the open session of the day before
+        has been flushed a couple of minutes after midnight
+        """
+        now = self.clock.now() - datetime.timedelta(seconds=2 * self.flush_interval)
+        return datetime.datetime.combine(now.date(), datetime.time())
+
+    def _closed_report(self, group, start, end, host=None):
+        """
+        the whole report from start to end, served from the cache while the data stays the same
+        """
+        key = 'v{}:{}:{}:{}:{}'.format(TrackState._meta.database.user_version, group,
+                                       '' if host is None else '@' + host, start, end)
+        generation = TrackState.get_value('generation', 0)
+        try:
+            with trackmac.models.report_cache():
+                cached = ReportCache.get_or_none((ReportCache.key == key) & (ReportCache.generation == generation))
+        except OperationalError:
+            logging.warning("Report cache not available", exc_info=True)
+            return self._aggregate(self._report_parts(group, start, end, host))
+        if cached:
+            return [ReportRow(*row) for row in json.loads(cached.rows)]
+        rows = self._aggregate(self._report_parts(group, start, end, host))
+        try:
+            with trackmac.models.report_cache():
+                ReportCache.store(key, generation, json.dumps(rows))
+        except OperationalError:
+            logging.warning("Report cache not available", exc_info=True)
+        return rows
+
+    def _report_parts(self, group, start, end, host=None):
+        """
+        queries of (name, seconds) rows from start to end, grouped by `domain`, `host`, a field of Application
+        or `domain_tag`, the tag of web sites. whole days are read from the daily rollup, records only for the
+        partial days at both edges
+        """
+        web = group in ('domain', 'domain_tag')
+        # fields of the records themselves, others are looked up in Application
+        own = group in ('domain', 'host')
+        first_day, last_day, edges = trackmac.utils.split_range(start, end)
+        parts = []
+        if first_day:
+            where = [(DailyUsage.day >= first_day) & (DailyUsage.day < last_day)]
+            if web:
+                where.append(DailyUsage.domain != '')
+            if host is not None:
+                where.append(DailyUsage.host == host)
+            if group in ('tag_name', 'domain_tag') and self._tags():
+                # summed up per application and web site first, so the rules see each of them once
+                rollup = DailyUsage.select(DailyUsage.app, DailyUsage.domain,
+                                           fn.SUM(DailyUsage.seconds).alias('seconds')).\
+                    where(*where).group_by(DailyUsage.app, DailyUsage.domain).alias('rollup')
+                parts.append(Application.select(self._tag_field(rollup.c.domain).alias('name'), rollup.c.seconds).
+                             join(rollup, on=(rollup.c.app_id == Application.id)))
+            else:
+                field = getattr(DailyUsage if own else Application, 'tag_name' if group == 'domain_tag' else group)
+                query = DailyUsage.select(field.alias('name'), DailyUsage.seconds.alias('seconds')).where(*where)
+                parts.append(query if own else query.join(Application))
+        for edge_start, edge_end in edges:
+            for model in (WebTrackRecord,) if web else (NormalTrackRecord, WebTrackRecord):
+                if group in ('tag_name', 'domain_tag'):
+                    field = self._tag_field(model.domain if model is WebTrackRecord else Value(''))
+                else:
+                    field = getattr(model if own else Application, group)
+                query = model.select(field.alias('name'),
+                                     trackmac.models.clipped_duration(model, edge_start, edge_end).alias('seconds')).\
+                    where(trackmac.models.overlapping(model, edge_start, edge_end))
+                if host is not None:
+                    query = query.where(model.host == host)
+                parts.append(query if own else query.join(Application))
+        return parts
+
+    def _tags(self):
+        """
+        TagMatcher of the tag rules, loaded again when they may have changed. it is the
+        `tag_of` function of the connection the models are bound to.
+        """
+        generation = TrackState.get_value('generation', 0)
+        if self._tag_matcher is None or generation != self._tag_generation:
+            self._tag_matcher = TagMatcher(TagRule.select(TagRule.tag_name, TagRule.kind, TagRule.pattern,
+                                                          TagRule.regex).order_by(TagRule.id).tuples())
+            self._tag_generation = generation
+        TrackState._meta.database.register_function(self._tag_matcher, 'tag_of', 3)
+        return self._tag_matcher
+
+    def _tag_field(self, domain):
+        """
+        tag of the rows of a query joined with Application, the tag of the application if there are no rules
+        """
+        if not self._tags():
+            return Application.tag_name
+        return fn.tag_of(Application.app_name, Application.tag_name, domain)
+
+    @staticmethod
+    def _aggregate(parts, limit=None):
+        """
+        add up the (name, seconds) rows of all parts in one UNION ALL query, longest first
+        """
+        if not parts:
+            return []
+        union = functools.reduce(operator.add, parts)
+        total = fn.SUM(union.c.seconds)
+        query = union.select_from(union.c.name, total).group_by(union.c.name).\
+            having(total > 0).order_by(total.desc(), union.c.name)
+        if limit:
+            query = query.limit(limit)
+        return [ReportRow(*row) for row in query.tuples()]
+
+    @staticmethod
+    def _export_fields(web):
+        model = WebTrackRecord if web else NormalTrackRecord
+        fields = [model.id, Application.app_name, model.start_datetime, model.end_datetime, model.duration]
+        if web:
+            fields += [PageTitle.title, PageUrl.url, model.domain]
+        return model, fields + [model.host]
+
+    def export_columns(self, web=False):
+        """
+        names of the values of the rows yielded by `export`
+        """
+        return [f.name for f in self._export_fields(web)[1]]
+
+    def export(self, start=None, end=None, web=False, since_id=None, batch_size=1000):
+        """
+        yield raw records started from start to end as tuples in id order.
+        rows are read in batches of `batch_size` after the last id seen (keyset, no OFFSET),
+        so memory stays flat however many records there are. records up to `since_id` are skipped,
+        the open record is left out since it still grows, it comes with the next export.
+        """
+        model, fields = self._export_fields(web)
+        where = []
+        if start:
+            where.append(model.start_datetime >= start)
+        if end:
+            where.append(model.start_datetime < end)
+        # the id range of the matching records, found on the start_datetime index
+        bounds = model.select(fn.MIN(model.id), fn.MAX(model.id))
+        if where:
+            bounds = bounds.where(*where)
+        lowest, highest = bounds.scalar(as_tuple=True)
+        if lowest is None:
+            return
+        state = TrackState.get_or_none(TrackState.name == OPEN_RECORD_KEYS[model])
+        if state and state.value is not None:
+            highest = min(highest, state.value - 1)
+        last_id = max(since_id or 0, lowest - 1)
+        while last_id < highest:
+            query = model.select(*fields).join(Application)
+            if web:
+                query = query.switch(model).join(PageUrl).switch(model).join(PageTitle, JOIN.LEFT_OUTER)
+            rows = list(query.
+                        where((model.id > last_id) & (model.id <= highest), *where).
+                        order_by(model.id).limit(batch_size).tuples())
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def search(self, text, start=None, end=None, limit=10):
+        """
+        web pages whose url or title contain all words of the text, best match first. the time spent on each
+        (from start to end if given), its first and last visit and number of records come with it.
+        """
+        words = text.split()
+        if not words:
+            return []
+        url_matches, title_matches = self._page_matches(PageUrl.url, words), self._page_matches(PageTitle.title, words)
+        ranks = dict(db.execute_sql(*url_matches).fetchall())
+        title_ranks = dict(db.execute_sql(*title_matches).fetchall())
+        if not ranks and not title_ranks:
+            return []
+        model = WebTrackRecord
+        seconds = model.duration
+        if start or end:
+            start = trackmac.utils.as_datetime(start or datetime.date(1970, 1, 1))
+            end = trackmac.utils.as_datetime(end or self.clock.now().date() + datetime.timedelta(days=1))
+            seconds = trackmac.models.clipped_duration(model, start, end)
+        query = model.select(model.url, model.title, fn.SUM(seconds), fn.MIN(model.start_datetime),
+                             fn.MAX(model.end_datetime), fn.COUNT(model.id))
+        if start or end:
+            query = query.where(trackmac.models.overlapping(model, start, end))
+        # the matches are found again inside the query, their ids could be more than sqlite takes as parameters
+        query = query.where(model.url.in_(SQL('(SELECT "id" FROM ({}))'.format(url_matches[0]), url_matches[1])) |
+                            model.title.in_(SQL('(SELECT "id" FROM ({}))'.format(title_matches[0]), title_matches[1])))
+        pages = {}
+        for url_id, title_id, seconds, first, last, visits in query.group_by(model.url, model.title).tuples():
+            page = pages.setdefault(url_id, {'rank': ranks.get(url_id), 'title': title_id, 'title_seconds': 0,
+                                             'duration': 0, 'first': first, 'last': last, 'visits': 0})
+            if title_id in title_ranks and (page['rank'] is None or title_ranks[title_id] < page['rank']):
+                page['rank'] = title_ranks[title_id]
+            # the title the page was seen with the longest
+            if seconds > page['title_seconds']:
+                page['title'], page['title_seconds'] = title_id, seconds
+            page['duration'] += seconds
+            page['first'], page['last'] = min(page['first'], first), max(page['last'], last)
+            page['visits'] += visits
+        best = sorted(pages.items(), key=lambda item: (item[1]['rank'], -item[1]['duration']))[:limit]
+        urls = dict(PageUrl.select(PageUrl.id, PageUrl.url).where(PageUrl.id << [url_id for url_id, _ in best]).
+                    tuples()) if best else {}
+        titles = dict(PageTitle.select(PageTitle.id, PageTitle.title).
+                      where(PageTitle.id << [page['title'] for _, page in best if page['title']]).tuples()) \
+            if best else {}
+        return [SearchRow(urls[url_id], titles.get(page['title']), page['duration'], page['first'], page['last'],
+                          page['visits']) for url_id, page in best]
+
+    @staticmethod
+    def _page_matches(field, words):
+        """
+        sql and parameters of the (id, rank) rows of urls or titles containing all words, lower ranks match better.
+        the full text index is used if sqlite comes with fts5, otherwise the values are scanned.
+        """
+        table = field.model._meta.table_name
+        if db.table_exists(table + '_search'):
+            return ('SELECT "rowid" AS "id", "rank" FROM "{0}_search" WHERE "{0}_search" MATCH ?'.format(table),
+                    [trackmac.utils.fts_query(words)])
+        return ('SELECT "id", 0 AS "rank" FROM "{}" WHERE {}'.format(table, ' AND '.join(
+            ['"{}" LIKE ? ESCAPE \'\\\''.format(field.column_name)] * len(words))),
+                [trackmac.utils.like_pattern(word) for word in words])
+
+    def read_only(self):
+        """
+        context in which reports run on a read-only connection
+        """
+        return trackmac.models.read_only()
+
+    def backfill(self, start=None, end=None):
+        """
+        rebuild the daily rollup from the records, for all days by default
+        """
+        with db.atomic():
+            DailyUsage.rebuild(start, end)
+            TrackState.increment('generation')
+
+    def set_auto_compact(self, gap, keep_days=None):
+        """
+        let the daemon compact with the given options, a gap of None turns it off
+        """
+        with db.atomic():
+            TrackState.set_value('auto_compact_gap', gap)
+            TrackState.set_value('auto_compact_keep_days', keep_days if gap is not None else None)
+
+    def set_metrics(self, enabled):
+        """
+        let the daemon write its metrics or not
+        """
+        TrackState.set_value('metrics', int(enabled))
+
+    def compact(self, gap=10, keep_days=None, archive=True, full_vacuum=True, max_days=None):
+        """
+        merge sessions split by short gaps, move records older than `keep_days` days to a gzipped
+        ndjson file in the archive folder (or only keep their daily usage) and give the freed pages back.
+        at most the `max_days` oldest days are merged and archived if given, `more` tells if some are left.
+        return counts of merged and archived records, the archive files and the bytes freed.
+        """
+        today = self.clock.now().date()
+        pages = db.pragma('page_count')
+        stats = {'merged': 0, 'archived': 0, 'archives': [], 'more': False}
+        day = TrackState.get_value('compacted_until')
+        day = datetime.date.fromordinal(day) if day else self._first_day()
+        # today is merged next time, its records still grow
+        last = today if day is None or max_days is None else min(today, day + datetime.timedelta(days=max_days))
+        while day and day < last:
+            with db.atomic():
+                stats['merged'] += self.merge_sessions(day, gap)
+                TrackState.set_value('compacted_until', (day + datetime.timedelta(days=1)).toordinal())
+            day += datetime.timedelta(days=1)
+        stats['more'] = bool(day and day < today)
+        if keep_days is not None:
+            before = today - datetime.timedelta(days=keep_days)
+            first = self._first_day() if max_days is not None else None
+            if first and first + datetime.timedelta(days=max_days) < before:
+                before = first + datetime.timedelta(days=max_days)
+                stats['more'] = True
+            for web in (False, True):
+                count, path = self.archive(before, web, archive)
+                stats['archived'] += count
+                if path:
+                    stats['archives'].append(path)
+        if stats['merged'] or stats['archived']:
+            TrackState.increment('generation')
+        self.vacuum(full_vacuum)
+        stats['freed'] = max(pages - db.pragma('page_count'), 0) * db.pragma('page_size')
+        return stats
+
+    def _first_day(self):
+        first = min([d for d in (NormalTrackRecord.select(fn.MIN(NormalTrackRecord.start_datetime)).scalar(),
+                                 WebTrackRecord.select(fn.MIN(WebTrackRecord.start_datetime)).scalar()) if d] or
+                    [None])
+        return first and first.date()
+
+    def merge_sessions(self, day, gap):
+        """
+        merge records of the day into the record right before them (in either table) if both are of the
+        same application and url and at most `gap` seconds apart. the durations add up and records running
+        past midnight are left alone, so reports and the daily usage stay the same. records merged from other
+        machines are left as they are, `merge` recognizes them by their start.
+        return the number of records merged away.
+        """
+        start = datetime.datetime.combine(day, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        open_ids = set((model, TrackState.get_value(key)) for model, key in OPEN_RECORD_KEYS.items())
+        cursors = []
+        for model in (NormalTrackRecord, WebTrackRecord):
+            extra = [model.url, model.title] if model is WebTrackRecord else [Value(None), Value(None)]
+            # (start, table, id, ...) so both cursors merge in start order, urls and titles are compared by id
+            cursors.append(model.select(model.start_datetime, Value(len(cursors)), model.id, model.app,
+                                        model.end_datetime, model.duration, *extra).
+                           where((model.start_datetime >= start) & (model.start_datetime < end) &
+                                 (model.host == '')).
+                           order_by(model.start_datetime, model.id).tuples())
+        models = (NormalTrackRecord, WebTrackRecord)
+        head, heads, merged = None, [], dict((model, []) for model in models)
+        for rec_start, table, rec_id, app_id, rec_end, duration, url, title in heapq.merge(*cursors):
+            model = models[table]
+            if (model, rec_id) in open_ids:
+                # still written by the daemon
+                head = None
+            elif head and head['model'] is model and head['app'] == app_id and head['url'] == url and \
+                    (rec_start - head['end']).total_seconds() <= gap and rec_end <= end:
+                head['end'] = max(head['end'], rec_end)
+                head['duration'] += duration
+                head['title'] = title if title is not None else head['title']
+                merged[model].append(rec_id)
+                if not head['changed']:
+                    head['changed'] = True
+                    heads.append(head)
+            else:
+                head = dict(model=model, id=rec_id, app=app_id, url=url, start=rec_start, end=rec_end,
+                            duration=duration, title=title, changed=False)
+        if heads:
+            TrackState.maximize(LONGEST_RECORD_KEY, max(int((head['end'] - head['start']).total_seconds())
+                                                        for head in heads))
+        for head in heads:
+            model = head['model']
+            fields = {'end_datetime': head['end'], 'duration': head['duration']}
+            if model is WebTrackRecord:
+                fields['title'] = head['title']
+            model.update(**fields).where(model.id == head['id']).execute()
+        for model, ids in merged.items():
+            for batch in chunked(ids, 500):
+                model.delete().where(model.id << batch).execute()
+        return sum(len(ids) for ids in merged.values())
+
+    def archive(self, before, web=False, to_file=True):
+        """
+        remove the records started before the day `before`, only their daily usage is kept.
+        they are written to a gzipped ndjson file in the archive folder first unless `to_file` is False.
+        return the number of records and the file.
+        """
+        model = WebTrackRecord if web else NormalTrackRecord
+        last_id, count, path = None, 0, None
+        if to_file:
+            if not os.path.exists(trackmac.config.TRACK_ARCHIVE_DIR):
+                os.makedirs(trackmac.config.TRACK_ARCHIVE_DIR)
+            path = os.path.join(trackmac.config.TRACK_ARCHIVE_DIR, '{}-{}.ndjson.gz'.format(
+                'web' if web else 'normal', before.strftime('%Y-%m-%d')))
+            tmp_path = path + '.tmp'
+            columns = self.export_columns(web)
+            with gzip.open(tmp_path, 'wb') as f:
+                for row in self.export(end=before, web=web):
+                    f.write(trackmac.utils.ndjson_line(columns, row).encode('utf8'))
+                    count += 1
+                    last_id = row[0]
+            if not count:
+                os.remove(tmp_path)
+                return 0, None
+            if os.path.exists(path):
+                # an earlier run with the same horizon, keep both
+                path = path.replace('.ndjson.gz', '-{}.ndjson.gz'.format(last_id))
+            os.rename(tmp_path, path)
+        else:
+            for row in self.export(end=before, web=web):
+                count += 1
+                last_id = row[0]
+            if not count:
+                return 0, None
+        # exactly the exported records, deleted in short transactions so the daemon is not held up
+        lowest = model.select(fn.MIN(model.id)).scalar()
+        for first in range(lowest - 1, last_id, 10000):
+            with db.atomic():
+                model.delete().where((model.id > first) & (model.id <= min(first + 10000, last_id)) &
+                                     (model.start_datetime < before)).execute()
+        with db.atomic():
+            if before.toordinal() > TrackState.get_value('archived_before', 0):
+                TrackState.set_value('archived_before', before.toordinal())
+            if web:
+                # urls and titles no record refers to any more
+                PageUrl.delete().where(PageUrl.id.not_in(WebTrackRecord.select(WebTrackRecord.url))).execute()
+                PageTitle.delete().where(PageTitle.id.not_in(
+                    WebTrackRecord.select(WebTrackRecord.title).where(WebTrackRecord.title.is_null(False)))).execute()
+        return count, path
+
+    def vacuum(self, full=True):
+        """
+        give the free pages back to the file system. a database created without incremental
+        auto vacuum is converted by a full VACUUM once, which rewrites the whole file.
+        """
+        if db.pragma('auto_vacuum') != 2:
+            if not full:
+                return
+            db.pragma('auto_vacuum', 'incremental')
+            db.execute_sql('VACUUM')
+        else:
+            # a plain execute only frees one page per step
+            db.connection().executescript('PRAGMA incremental_vacuum;')
+        db.pragma('wal_checkpoint', 'TRUNCATE')
+
+    def merge(self, path, host, batch_size=50000):
+        """
+        copy the records of the trackmac database at `path`, tracked on the machine named `host`.
+        applications are matched by name, tags, tag rules and blocked applications are carried over. records merged
+        before (same host, application, start and url), records of blocked applications and the open record are
+        skipped, so merging a newer copy of the database only adds what is new. the daily usage of the days the
+        database has archived is copied, records of days archived here only go to the daily usage.
+        return counts of new applications, merged normal and web records, records only added to the daily usage,
+        archived days copied and skipped records.
+        """
+        if not os.path.isfile(path):
+            raise ValueError('{} does not exist.'.format(path))
+        if os.path.exists(db.database) and os.path.samefile(path, db.database):
+            raise ValueError('Cannot merge the database into itself.')
+        db.execute_sql('ATTACH DATABASE ? AS "src"', (path,))
+        try:
+            version = db.execute_sql('PRAGMA "src".user_version').fetchone()[0]
+            if version != db.user_version:
+                raise ValueError('{} is at version {}, run `tm migrate` on its machine first.'.format(path, version))
+            stats = {'applications': self._merge_catalog(), 'rolled_up': 0, 'skipped': 0}
+            stats['archived_days'] = self._merge_archived_usage(host)
+            for model, name in ((NormalTrackRecord, 'normal'), (WebTrackRecord, 'web')):
+                stats[name], rolled_up, skipped = self._merge_records(model, host, batch_size)
+                stats['rolled_up'] += rolled_up
+                stats['skipped'] += skipped
+            TrackState.increment('generation')
+        finally:
+            for table in ('merge_app', 'merge_url', 'merge_title'):
+                db.execute_sql('DROP TABLE IF EXISTS "temp"."{}"'.format(table))
+            db.execute_sql('DETACH DATABASE "src"')
+        return stats
+
+    @staticmethod
+    def _merge_catalog():
+        """
+        carry over the block list, applications, tags and tag rules of the attached database and map its
+        ids of applications, urls and titles to ours in temporary tables.
+        return the number of new applications.
+        """
+        with db.atomic():
+            db.execute_sql('INSERT INTO "blockedapplication" ("name") SELECT DISTINCT "name" '
+                           'FROM "src"."blockedapplication" '
+                           'WHERE "name" NOT IN (SELECT "name" FROM "main"."blockedapplication")')
+            db.execute_sql('INSERT INTO "main"."tagrule" ("tag_name", "kind", "pattern", "regex") '
+                           'SELECT "tag_name", "kind", "pattern", "regex" FROM "src"."tagrule" AS s '
+                           'WHERE NOT EXISTS (SELECT 1 FROM "main"."tagrule" AS r WHERE r."tag_name" = s."tag_name" '
+                           'AND r."kind" = s."kind" AND r."pattern" = s."pattern" AND r."regex" = s."regex") '
+                           'ORDER BY s."id"')
+            # tags given on this machine win
+            db.execute_sql('UPDATE "main"."application" SET "tag_name" = (SELECT MAX(s."tag_name") '
+                           'FROM "src"."application" AS s WHERE s."app_name" = "application"."app_name") '
+                           'WHERE "tag_name" IS NULL AND "app_name" IN '
+                           '(SELECT "app_name" FROM "src"."application" WHERE "tag_name" IS NOT NULL)')
+            created = db.execute_sql('INSERT INTO "main"."application" ("app_name", "tag_name") '
+                                     'SELECT "app_name", MAX("tag_name") FROM "src"."application" '
+                                     'WHERE "app_name" NOT IN (SELECT "app_name" FROM "main"."application") '
+                                     'AND "app_name" NOT IN (SELECT "name" FROM "main"."blockedapplication") '
+                                     'GROUP BY "app_name"').rowcount
+            # the first row wins if an application name is stored twice, as in `reload_catalog`
+            db.execute_sql('CREATE TEMP TABLE "merge_app" ("src_id" INTEGER PRIMARY KEY, "dst_id" INTEGER NOT NULL)')
+            db.execute_sql('INSERT INTO "temp"."merge_app" SELECT s."id", MIN(a."id") FROM "src"."application" AS s '
+                           'JOIN "main"."application" AS a ON a."app_name" = s."app_name" '
+                           'WHERE s."app_name" NOT IN (SELECT "name" FROM "main"."blockedapplication") '
+                           'GROUP BY s."id"')
+            for table, column in (('pageurl', 'url'), ('pagetitle', 'title')):
+                db.execute_sql('INSERT OR IGNORE INTO "main"."{0}" ("{1}") SELECT "{1}" FROM "src"."{0}"'.format(
+                    table, column))
+                db.execute_sql('CREATE TEMP TABLE "merge_{}" ("src_id" INTEGER PRIMARY KEY, '
+                               '"dst_id" INTEGER NOT NULL)'.format(column))
+                db.execute_sql('INSERT INTO "temp"."merge_{1}" SELECT s."id", m."id" FROM "src"."{0}" AS s '
+                               'JOIN "main"."{0}" AS m ON m."{1}" = s."{1}"'.format(table, column))
+        return created
+
+    @staticmethod
+    def _merge_archived_usage(host):
+        """
+        copy the daily usage of the days the attached database has archived. it is all that is left of
+        them there, so it replaces what earlier merges of the same host added for those days.
+        return the number of days.
+        """
+        archived_before = db.execute_sql('SELECT "value" FROM "src"."trackstate" WHERE "name" = ?',
+                                         ('archived_before',)).fetchone()
+        if not archived_before or not archived_before[0]:
+            return 0
+        horizon = datetime.date.fromordinal(archived_before[0]).strftime('%Y-%m-%d')
+        with db.atomic():
+            db.execute_sql('INSERT INTO "main"."dailyusage" ("day", "app_id", "domain", "host", "seconds") '
+                           'SELECT d."day", a."dst_id", d."domain", '
+                           'CASE d."host" WHEN \'\' THEN ? ELSE d."host" END AS "src_host", SUM(d."seconds") '
+                           'FROM "src"."dailyusage" AS d JOIN "temp"."merge_app" AS a ON a."src_id" = d."app_id" '
+                           'WHERE d."day" < ? GROUP BY d."day", a."dst_id", d."domain", "src_host" '
+                           'ON CONFLICT ("day", "app_id", "domain", "host") DO UPDATE SET "seconds" = excluded."seconds"',
+                           (host, horizon))
+        return db.execute_sql('SELECT COUNT(DISTINCT "day") FROM "src"."dailyusage" WHERE "day" < ?',
+                              (horizon,)).fetchone()[0]
+
+    @staticmethod
+    def _merge_records(model, host, batch_size):
+        """
+        insert the new records of the model from the attached database in transactions of
+        `batch_size` source ids, together with their daily usage. new records of days archived
+        here are only added to the daily usage.
+        return the numbers of merged, rolled up and skipped records.
+        """
+        web = model is WebTrackRecord
+        table = model._meta.table_name
+        lowest, highest, total = db.execute_sql('SELECT MIN("id"), MAX("id"), COUNT(*) FROM "src"."{}"'.format(
+            table)).fetchone()
+        if not total:
+            return 0, 0, 0
+        open_record = db.execute_sql('SELECT "value" FROM "src"."trackstate" WHERE "name" = ?',
+                                     (OPEN_RECORD_KEYS[model],)).fetchone()
+        archived_before = TrackState.get_value('archived_before')
+        # archived days only keep their daily usage here, records of them could not be told apart later
+        horizon = datetime.date.fromordinal(archived_before).strftime('%Y-%m-%d') if archived_before else ''
+        # records merged into the attached database keep the machine they came from
+        source_host = 'CASE r."host" WHEN \'\' THEN ? ELSE r."host" END'
+        sql = ('INSERT INTO "main"."{table}" ("app_id", "start_datetime", "end_datetime", "duration", '
+               '"is_current", "host"{web_columns}) '
+               'SELECT a."dst_id", r."start_datetime", r."end_datetime", r."duration", 0, {host}{web_values} '
+               'FROM "src"."{table}" AS r JOIN "temp"."merge_app" AS a ON a."src_id" = r."app_id" {web_joins}'
+               'WHERE r."id" > ? AND r."id" <= ? AND r."id" != ? AND r."start_datetime" >= ? '
+               'AND NOT EXISTS (SELECT 1 FROM "main"."{table}" AS m WHERE m."start_datetime" = r."start_datetime" '
+               'AND m."app_id" = a."dst_id" AND m."host" = {host}{web_key})').format(
+            table=table, host=source_host,
+            web_columns=', "title_id", "url_id", "domain"' if web else '',
+            web_values=', t."dst_id", u."dst_id", r."domain"' if web else '',
+            web_joins='JOIN "temp"."merge_url" AS u ON u."src_id" = r."url_id" '
+                      'LEFT OUTER JOIN "temp"."merge_title" AS t ON t."src_id" = r."title_id" ' if web else '',
+            web_key=' AND m."url_id" = u."dst_id"' if web else '')
+        open_id = (open_record and open_record[0]) or -1
+        merged = 0
+        for first in range(lowest - 1, highest, batch_size):
+            with db.atomic():
+                after_id = model.select(fn.MAX(model.id)).scalar() or 0
+                count = db.execute_sql(sql, (host, first, first + batch_size, open_id, horizon, host)).rowcount
+                if count:
+                    DailyUsage.add_records(model, after_id=after_id)
+                    trackmac.models.store_longest_record(model, after_id=after_id)
+                merged += count
+        # records of the archived days cannot be found again to tell whether they were merged before,
+        # so the highest source id merged is kept per host and only newer ones are rolled up
+        mark = 'merged_{}@{}'.format(table, host)
+        rolled_up = 0
+        with db.atomic():
+            if horizon:
+                rows = db.execute_sql(
+                    'SELECT a."dst_id", {domain}, {host}, r."start_datetime", r."end_datetime", r."duration" '
+                    'FROM "src"."{table}" AS r JOIN "temp"."merge_app" AS a ON a."src_id" = r."app_id" '
+                    'WHERE r."id" > ? AND r."id" != ? AND r."start_datetime" < ?'.format(
+                        domain='r."domain"' if web else "''", host=source_host, table=table),
+                    (host, TrackState.get_value(mark, 0), open_id, horizon)).fetchall()
+                for app_id, domain, rec_host, rec_start, rec_end, duration in rows:
+                    rec_start = model.start_datetime.python_value(rec_start)
+                    rec_end = model.end_datetime.python_value(rec_end)
+                    for day, seconds in trackmac.utils.split_by_day(rec_start, rec_end, duration):
+                        DailyUsage.add(day, app_id, domain, seconds, rec_host)
+                rolled_up = len(rows)
+            # the open record is merged once it is closed
+            TrackState.set_value(mark, highest if open_id < 0 else min(highest, open_id - 1))
+        return merged, rolled_up, total - merged - rolled_up
 
     @property
     def black_list(self):
@@ -108,21 +965,25 @@ class TimeTracking(object):
         """
         block a application from being tracked and delete all existing track records
         """
-        if flag:
-            q = Application.select().where(Application.app_name == name)
-            num_of_rows = q.count()
-            if num_of_rows == 0:
-                return False
-                # elif num_of_rows > 1:
-                #     return num_of_rows, u'Found {}.Please use specify the right one.'.format(",".join([x.app_name for x in q]))
-            # delete related records first
-            WebTrackRecord.delete().where(WebTrackRecord.app_id == q[0].id).execute()
-            NormalTrackRecord.delete().where(NormalTrackRecord.app_id == q[0].id).execute()
-            Application.delete().where(Application.app_name % name).execute()
-            BlockedApplication.get_or_create(name=q[0].app_name)
-            return True
-        else:
-            return BlockedApplication.delete().where(name == name).execute() > 0
+        # records, daily usage and the cache generation change together or not at all
+        with db.atomic():
+            if flag:
+                q = Application.select().where(Application.app_name == name)
+                num_of_rows = q.count()
+                if num_of_rows == 0:
+                    return False
+                    # elif num_of_rows > 1:
+                    #     return num_of_rows, u'Found {}.Please use specify the right one.'.format(",".join([x.app_name for x in q]))
+                # delete related records first
+                WebTrackRecord.delete().where(WebTrackRecord.app_id == q[0].id).execute()
+                NormalTrackRecord.delete().where(NormalTrackRecord.app_id == q[0].id).execute()
+                DailyUsage.delete().where(DailyUsage.app_id == q[0].id).execute()
+                TrackState.increment('generation')
+                Application.delete().where(Application.app_name % name).execute()
+                BlockedApplication.get_or_create(name=q[0].app_name)
+                return True
+            else:
+                return BlockedApplication.delete().where(name == name).execute() > 0
 
     def add_tag(self, tag_name, app_name):
         """
@@ -131,12 +992,47 @@ class TimeTracking(object):
         app_set = Application.select().where(Application.app_name == app_name)
         if app_set.exists():
             app = app_set[0]
-            app.tag_name = tag_name
-            app.save()
+            with db.atomic():
+                app.tag_name = tag_name
+                app.save()
+                TrackState.increment('generation')
             return True
         else:
             return False
 
+    def add_tag_rule(self, tag_name, pattern, kind='app', regex=False):
+        """
+        tag the applications (kind `app`) or web sites (kind `domain`) matching a glob, or a regular
+        expression if `regex`. raise ValueError if the pattern is not valid, return the id of the rule.
+        """
+        if kind not in trackmac.tagging.KINDS:
+            raise ValueError('Unknown kind of rule {}.'.format(kind))
+        try:
+            trackmac.tagging.compile_pattern(pattern, regex)
+        except re.error as e:
+            raise ValueError('Invalid pattern {}: {}'.format(pattern, e))
+        with db.atomic():
+            rule_id = TagRule.insert(tag_name=tag_name, kind=kind, pattern=pattern, regex=regex).execute()
+            TrackState.increment('generation')
+        return rule_id
+
+    def delete_tag_rule(self, rule_id):
+        """
+        delete the tag rule, False if there is none with the id
+        """
+        with db.atomic():
+            if not TagRule.delete().where(TagRule.id == rule_id).execute():
+                return False
+            TrackState.increment('generation')
+        return True
+
+    @property
+    def tag_rules(self):
+        """
+        tag rules in the order they apply
+        """
+        return TagRule.select().order_by(TagRule.id)
+
     @property
     def tags(self):
         """
@@ -149,10 +1045,119 @@ class TimeTracking(object):
 
     @property
     def is_not_running(self):
-        return trackmac.cocoa.daemon_status(trackmac.config.TRACK_PLIST_NAME[:-6].encode("utf8"))
+        import trackmac.cocoa
+        try:
+            return trackmac.cocoa.daemon_status(trackmac.config.TRACK_PLIST_NAME[:-6].encode("utf8"))
+        except OSError:
+            # no launchd to ask, e.g. reading a copied database on another host
+            return False
+
+
+class LiveReport(object):
+    """
+    Time per group from start to end kept in memory. A refresh only reads the records added since the
+    last one and the open records the daemon still extends, so it costs as much as has changed.
+    Anything else changing the records, e.g. `tm block`, `tm merge` or `tm compact`, increments the
+    generation and the report is computed again.
+    """
+
+    def __init__(self, tracker, group, start, end, host=None):
+        self.tracker = tracker
+        self.group = group
+        self.start, self.end = trackmac.utils.as_datetime(start), trackmac.utils.as_datetime(end)
+        self.host = host
+        self.models = (WebTrackRecord,) if group in ('domain', 'domain_tag') else (NormalTrackRecord, WebTrackRecord)
+        self.generation = None
+        self.totals = {}
+        # highest id seen per model
+        self.last_ids = {}
+        # {id: (name, seconds)} of the open record per model, as counted in the totals
+        self.open = {}
+        self.applications = {}
+
+    def refresh(self):
+        """
+        bring the totals up to date and return them as report rows, longest first
+        """
+        # all queries of a refresh see the same snapshot
+        with TrackState._meta.database.atomic():
+            generation = TrackState.get_value('generation', 0)
+            if generation != self.generation:
+                self.reset(generation)
+            else:
+                for model in self.models:
+                    self.update(model)
+        rows = [ReportRow(name, seconds) for name, seconds in self.totals.items() if seconds > 0]
+        return sorted(rows, key=lambda row: (-row.duration, row.name or ''))
+
+    def reset(self, generation):
+        self.generation = generation
+        self.applications = {}
+        if self.group in ('tag_name', 'domain_tag'):
+            self.tracker._tags()
+        self.totals = dict(self.tracker._report(self.group, self.start, self.end, None, self.host))
+        for model in self.models:
+            self.last_ids[model] = model.select(fn.MAX(model.id)).scalar() or 0
+            self.open[model] = {}
+            open_id = TrackState.get_value(OPEN_RECORD_KEYS[model])
+            if open_id is not None:
+                for row in self.records(model, model.id == open_id):
+                    self.open[model][row[0]] = self.counted(model, row)
+
+    def update(self, model):
+        """
+        apply the records of the model added or extended since the last refresh
+        """
+        opened = self.open[model]
+        open_id = TrackState.get_value(OPEN_RECORD_KEYS[model])
+        self.open[model] = {}
+        for row in self.records(model, (model.id > self.last_ids[model]) | (model.id << list(opened))):
+            if row[0] in opened:
+                name, seconds = opened[row[0]]
+                self.totals[name] = self.totals.get(name, 0) - seconds
+            name, seconds = self.counted(model, row)
+            self.totals[name] = self.totals.get(name, 0) + seconds
+            if row[0] == open_id:
+                self.open[model][row[0]] = name, seconds
+            self.last_ids[model] = max(self.last_ids[model], row[0])
+
+    @staticmethod
+    def records(model, where):
+        domain = model.domain if model is WebTrackRecord else Value(None)
+        return model.select(model.id, model.app, model.start_datetime, model.end_datetime, model.duration,
+                            domain, model.host).where(where).tuples()
+
+    def counted(self, model, row):
+        """
+        name of the group and seconds from start to end of the record
+        """
+        rec_id, app_id, rec_start, rec_end, duration, domain, host = row
+        if self.group == 'domain':
+            name = domain
+        elif self.group == 'host':
+            name = host
+        else:
+            if app_id not in self.applications:
+                self.applications = dict((app.id, app) for app in Application.select())
+            app = self.applications[app_id]
+            if self.group in ('tag_name', 'domain_tag'):
+                name = self.tracker._tag_matcher(app.app_name, app.tag_name, domain or '')
+            else:
+                name = getattr(app, self.group)
+        if self.host is not None and host != self.host:
+            return name, 0
+        return name, (trackmac.utils.seconds_before(rec_start, rec_end, duration, self.end) -
+                      trackmac.utils.seconds_before(rec_start, rec_end, duration, self.start))
+
+
+def _shutdown(signum, frame):
+    # unwind the loop so the session buffer gets flushed
+    raise SystemExit(0)
 
 
 def main():
+    signal.signal(signal.SIGTERM, _shutdown)
+    trackmac.utils.create_database()
     TimeTracking().start()
 
 
@@ -4,30 +4,6 @@ import ctypes
 import ctypes.util
 import trackmac.config
 
-foundation = ctypes.cdll.LoadLibrary(ctypes.util.find_library('Foundation'))
-core_foundation = ctypes.cdll.LoadLibrary(ctypes.util.find_library('CoreFoundation'))
-appkit = ctypes.cdll.LoadLibrary(ctypes.util.find_library('AppKit'))
-objc = ctypes.cdll.LoadLibrary(ctypes.util.find_library('objc'))
-scripting_bridge = ctypes.cdll.LoadLibrary(ctypes.util.find_library('ScriptingBridge'))
-service_management = ctypes.cdll.LoadLibrary(ctypes.util.find_library('ServiceManagement'))
-
-objc.objc_getClass.argtypes = [ctypes.c_char_p]
-objc.objc_getClass.restype = ctypes.c_void_p
-
-objc.objc_msgSend.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
-objc.objc_msgSend.restype = ctypes.c_void_p
-
-objc.sel_registerName.argtypes = [ctypes.c_char_p]
-objc.sel_registerName.restype = ctypes.c_void_p
-
-objc.object_getClassName.argtypes = [ctypes.c_void_p]
-objc.object_getClassName.restype = ctypes.c_char_p
-
-CFStringCreateWithCString = core_foundation.CFStringCreateWithCString
-CFStringCreateWithCString.restype = ctypes.c_void_p
-CFStringCreateWithCString.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32]
-
-
 def memoize(function):
     memo = {}
 
@@ -41,20 +17,56 @@ def memoize(function):
     return wrapper
 
 
+@memoize
+def framework(name):
+    """
+    load a framework on first use, so importing this module stays cheap
+    and works on hosts without the frameworks
+    """
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise OSError('Could not find the {} framework'.format(name))
+    return ctypes.cdll.LoadLibrary(path)
+
+
+@memoize
+def objc_runtime():
+    """
+    the objc runtime with the classes of the frameworks used below registered
+    """
+    for name in ('Foundation', 'CoreFoundation', 'AppKit', 'ScriptingBridge'):
+        framework(name)
+    objc = framework('objc')
+
+    objc.objc_getClass.argtypes = [ctypes.c_char_p]
+    objc.objc_getClass.restype = ctypes.c_void_p
+
+    objc.objc_msgSend.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    objc.objc_msgSend.restype = ctypes.c_void_p
+
+    objc.sel_registerName.argtypes = [ctypes.c_char_p]
+    objc.sel_registerName.restype = ctypes.c_void_p
+
+    objc.object_getClassName.argtypes = [ctypes.c_void_p]
+    objc.object_getClassName.restype = ctypes.c_char_p
+    return objc
+
+
 @memoize
 def C(name):
-    return objc.objc_getClass(name)
+    return objc_runtime().objc_getClass(name)
 
 
 @memoize
 def S(name):
-    return objc.sel_registerName(name)
+    return objc_runtime().sel_registerName(name)
 
 
 def send(obj, sel, param=None):
     """
     sends a message with a simple return value to an instance of a class.
     """
+    objc = objc_runtime()
     objc.objc_msgSend.argtypes = [ctypes.c_void_p] * 3
     objc.objc_msgSend.restype = ctypes.c_void_p
     return objc.objc_msgSend(obj, sel, param)
@@ -78,6 +90,9 @@ def _convert_nsstring_to_str(obj):
 #     """
 #     Python string to CFStringRef
 #     """
+#     CFStringCreateWithCString = framework('CoreFoundation').CFStringCreateWithCString
+#     CFStringCreateWithCString.restype = ctypes.c_void_p
+#     CFStringCreateWithCString.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32]
 #     kCFAllocatorDefault = ctypes.c_void_p()
 #     kCFStringEncodingUTF8 = 0x08000100
 #     return CFStringCreateWithCString(kCFAllocatorDefault,
@@ -131,7 +146,9 @@ def current_tab(brower_name):
     """
     get the current active tab
     """
-    broswer_specifics = trackmac.config.BROWSERS[brower_name]
+    # the config holds text, the objc runtime takes c strings
+    broswer_specifics = dict((key, value.encode('utf8'))
+                             for key, value in trackmac.config.BROWSERS[brower_name].items())
     chrome = send(C(b'SBApplication'), S(b'applicationWithBundleIdentifier:'),
                   _convert_str_to_nsstring(broswer_specifics['bundle_id']))
     windows = send(chrome, S(b'windows'))
@@ -153,6 +170,7 @@ def daemon_status(label):
     """
     get current launchd job exit status
     """
+    service_management = framework('ServiceManagement')
     SMJobCopyDictionary = service_management.SMJobCopyDictionary
     SMJobCopyDictionary.restype = ctypes.c_void_p
     SMJobCopyDictionary.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
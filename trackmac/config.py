@@ -8,6 +8,21 @@ TRACK_DIR = os.path.expanduser('~/Library/Application Support/com.github.macleek
 TRACK_DB_FILE = TRACK_DIR + 'track.db'
 TRACK_LOG_FILE = TRACK_DIR + 'track.log'
 TRACK_PLIST_NAME = 'com.github.macleek.trackmac.plist'
+# seconds between two writes of the open session
+FLUSH_INTERVAL = 60
+# seconds to wait for the current tab of a browser before using the last known one
+PROBE_TIMEOUT = 0.5
+# seconds between two writes of the daemon metrics shown by `tm stats`
+METRICS_INTERVAL = 60
+# seconds between two refreshes of `tm list --watch`
+WATCH_INTERVAL = 2
+# records moved out of the database by `tm compact`
+TRACK_ARCHIVE_DIR = TRACK_DIR + 'archive/'
+# the daemon compacts at most once a day, while one of these applications is frontmost
+COMPACT_INTERVAL = 24 * 3600
+# days merged or archived per tick, so a long backlog does not hold up sampling
+COMPACT_DAYS = 7
+IDLE_APPLICATIONS = ['loginwindow', 'ScreenSaverEngine']
 USER_LAUNCHAGENTS_DIR = os.path.expanduser('~/Library/LaunchAgents')
 BROWSERS = {
     'Google Chrome': {
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+import csv
 import json
+import time
+import functools
 from datetime import datetime, date, timedelta
 
 import click
 
-import trackmac.app
 import trackmac.config
 import trackmac.utils
+import trackmac.metrics
 
 
 class MutuallyExclusiveOption(click.Option):
@@ -30,6 +34,20 @@ class MutuallyExclusiveOption(click.Option):
         )
 
 
+def pass_tracker(f):
+    """
+    like click.pass_obj, but the TimeTracking object and with it peewee and
+    the models are only loaded by the commands that need them.
+    """
+    def new_func(*args, **kwargs):
+        ctx = click.get_current_context()
+        if ctx.obj is None:
+            import trackmac.app
+            ctx.obj = trackmac.app.TimeTracking()
+        return f(ctx.obj, *args, **kwargs)
+    return functools.update_wrapper(new_func, f)
+
+
 _SHORTCUT_OPTIONS = ['month', 'week', 'day']
 
 
@@ -37,7 +55,7 @@ _SHORTCUT_OPTIONS = ['month', 'week', 'day']
 @click.version_option(version=trackmac.config.VERSION, prog_name='Trackmac')
 @click.pass_context
 def cli(ctx):
-    ctx.obj = trackmac.app.TimeTracking()
+    ctx.obj = None
 
 
 @cli.command()
@@ -52,6 +70,44 @@ def setup(ctx):
     click.echo('Done.')
 
 
+@cli.command()
+@click.pass_context
+def migrate(ctx):
+    """
+    Upgrade the database of an older version.
+    """
+    import trackmac.migrations
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    for name in trackmac.migrations.migrate():
+        click.echo(u'Applied migration {}'.format(name))
+    click.echo(trackmac.utils.style('time', 'Database is at version {}.'.format(
+        trackmac.migrations.current_version())))
+
+
+@cli.command()
+@pass_tracker
+@click.pass_context
+@click.option('-f', '--from', 'start_', type=str,
+              help="The first day to rebuild.Format:%Y-%m-%d")
+@click.option('-t', '--to', 'end_', type=str,
+              help="The last day to rebuild (inclusive).Format:%Y-%m-%d")
+def backfill(ctx, tt, start_, end_):
+    """
+    Rebuild the daily usage used by reports from the track records.
+
+    All days are rebuilt by default.
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    start = start_ and datetime.strptime(start_, "%Y-%m-%d").date()
+    end = end_ and datetime.strptime(end_, "%Y-%m-%d").date() + timedelta(days=1)
+    tt.backfill(start, end)
+    click.echo(trackmac.utils.style('time', 'Daily usage rebuilt.'))
+
+
 def abort_if_false(ctx, param, value):
     if not value:
         ctx.abort()
@@ -93,7 +149,7 @@ def start(ctx):
 
 
 @cli.command()
-@click.pass_obj
+@pass_tracker
 @click.argument('web', required=False)
 @click.pass_context
 @click.option('-f', '--from', 'start_', cls=MutuallyExclusiveOption, type=str,
@@ -105,25 +161,31 @@ def start(ctx):
               mutually_exclusive=_SHORTCUT_OPTIONS,
               help="The date at which the report should stop (inclusive).Format:%Y-%m-%d")
 @click.option('-w', '--week', cls=MutuallyExclusiveOption, type=str,
-              flag_value=trackmac.utils.get_start_date_for_period('week'),
+              flag_value='week',
               mutually_exclusive=['day', 'month', 'year'],
               help='Reports application usage for current week.')
 @click.option('-m', '--month', cls=MutuallyExclusiveOption, type=str,
-              flag_value=trackmac.utils.get_start_date_for_period('month'),
+              flag_value='month',
               mutually_exclusive=['week', 'day', 'year'],
               help='Reports application usage for current month')
 @click.option('-d', '--day', cls=MutuallyExclusiveOption, type=str,
-              flag_value=trackmac.utils.get_start_date_for_period('day'),
+              flag_value='day',
               mutually_exclusive=['week', 'month', 'year'],
               help='Reports application usage for yesterday.')
 @click.option('-n', '--num', type=int, default=10,
               help='Only show top n applications(default to 10).')
 @click.option('-T', '--tags', 'tags', is_flag=True,
               help="Reports application usage group by tags")
+@click.option('-M', '--machines', 'machines', is_flag=True,
+              help="Reports usage group by the machines merged with `tm merge`")
+@click.option('-H', '--host',
+              help="Only reports usage on this machine merged with `tm merge`, '' for this one")
 @click.option('-O', '--output',
               type=click.Path(file_okay=True, dir_okay=True, writable=True, resolve_path=True),
               help="Output json data to the specified file")
-def list(ctx, tt, web, start_, end_, week, month, day, num, tags, output):
+@click.option('--watch', is_flag=True,
+              help="Keep the report on screen and up to date until Ctrl-C")
+def list(ctx, tt, web, start_, end_, week, month, day, num, tags, machines, host, output, watch):
     """
     Display applications being tracked.
 
@@ -151,6 +213,8 @@ def list(ctx, tt, web, start_, end_, week, month, day, num, tags, output):
 
     Successfully written to /position/to/trackdata.json
 
+    $ tm list -T --watch
+
     """
     if not trackmac.utils.has_set_up():
         click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
@@ -160,35 +224,148 @@ def list(ctx, tt, web, start_, end_, week, month, day, num, tags, output):
         click.echo(trackmac.utils.style('error', 'Warning:Trackmac daemon not running.Run `tm start` first.\n'))
 
     start_ = datetime.strptime(start_, "%Y-%m-%d").date()
-    for start_date in (_ for _ in [day, week, month]
-                       if _ is not None):
-        start_ = start_date
+    for period in (_ for _ in [day, week, month]
+                   if _ is not None):
+        start_ = trackmac.utils.get_start_date_for_period(period)
     end = datetime.strptime(end_, "%Y-%m-%d").date() + timedelta(days=1)
     if start_ > end:
         raise click.ClickException("'from' must be anterior to 'to'")
+    if web is not None and web.lower() != 'web':
+        raise click.UsageError(
+            'Use `web` to display web browsing statistics',
+        )
     if tags:
-        records = tt.report(start_, end, 'tag_name')
-        name = 'tag_name'
-        others = sum(records.pop(i)['duration'] for (i, r) in enumerate(records) if not r[name])
-        if others:
-            records.append({'tag_name': 'Others', 'duration': others})
-    elif web and web.lower() == 'web':
-        records = tt.web_report(start_, end)
+        name = 'domain_tag' if web else 'tag_name'
+    elif machines:
+        name = 'host'
+    elif web:
         name = 'domain'
-    elif web is None:
-        records = tt.report(start_, end, 'app_name')
+    else:
         name = 'app_name'
+    if watch:
+        if output:
+            raise click.UsageError('--watch shows the report on screen, it cannot be written to a file.')
+        with tt.read_only():
+            live = tt.live_report(name, start_, end, host)
+            try:
+                while True:
+                    records = live.refresh()[:num]
+                    click.clear()
+                    _echo_report(records, name, start_, end, machines)
+                    time.sleep(trackmac.config.WATCH_INTERVAL)
+            except KeyboardInterrupt:
+                return
+    with tt.read_only():
+        if name in ('domain', 'domain_tag'):
+            records = tt.web_report(start_, end, num, host, tags=name == 'domain_tag')
+        else:
+            records = tt.report(start_, end, name, num, host)
+    if output and records:
+        # applications without a tag are reported together
+        others = 'This Mac' if machines else 'Others'
+        records = [{name: rec.name or others, 'duration': rec.duration} for rec in records]
+        try:
+            with open(output, 'w') as f:
+                json.dump(records, f)
+        except IOError:
+            raise click.FileError(output, hint='IOError')
+        else:
+            click.echo(trackmac.utils.style('time', 'Successfully written to {}'.format(output)))
     else:
-        raise click.UsageError(
-            'Use `web` to display web browsing statistics',
-        )
+        _echo_report(records, name, start_, end, machines)
+
+
+def _echo_report(records, name, start, end, machines=False):
     if not records:
         click.echo(trackmac.utils.style('time', 'No data being collected.Please wait for a moment.'))
         return
-    records = sorted(records, key=lambda x: x['duration'], reverse=True)[:num]
-    max_len = max(len(rec[name].encode("utf8")) for rec in records if rec[name])
-    # output to file
+    # applications without a tag are reported together
+    others = 'This Mac' if machines else 'Others'
+    records = [{name: rec.name or others, 'duration': rec.duration} for rec in records]
+    max_len = max(len(rec[name].encode("utf8")) for rec in records)
+    click.echo(trackmac.utils.style('date', "\t" + trackmac.utils.fill_text_to_print_width(
+        start.strftime("%Y %b %d") + " - " + end.strftime("%Y %b %d"), max_len + 22)))
+    click.echo(trackmac.utils.style('date', "\t" + trackmac.utils.fill_text_to_print_width(u"─" * 29, max_len + 24)))
+    total_time = sum(r['duration'] for r in records)
+    for rec in records:
+        click.echo(u"\t{project} {time} {percentage}".format(
+            time=trackmac.utils.style('time', '{:>11}'.format(trackmac.utils.format_timedelta(rec['duration']))),
+            project=trackmac.utils.style(
+                'project', trackmac.utils.fill_text_to_print_width(rec[name], max_len)
+            ),
+            percentage=trackmac.utils.style('tag', trackmac.utils.get_progress(rec['duration'], total_time))
+        ))
+
+
+@cli.command()
+@pass_tracker
+@click.argument('web', required=False)
+@click.pass_context
+@click.option('-w', '--week', 'period', flag_value='week', default=True,
+              help='Compares this week with last week up to the same time(default).')
+@click.option('-m', '--month', 'period', flag_value='month',
+              help='Compares this month with last month up to the same day and time.')
+@click.option('-y', '--year', 'period', flag_value='year',
+              help='Compares this month with the same month last year up to the same day and time.')
+@click.option('-r', '--range', 'ranges', multiple=True,
+              help="Compares these ranges instead, two or more.Format:%Y-%m-%d:%Y-%m-%d (inclusive)")
+@click.option('-n', '--num', type=int, default=10,
+              help='Only show the n biggest changes(default to 10).')
+@click.option('-T', '--tags', 'tags', is_flag=True,
+              help="Compares application usage group by tags")
+@click.option('-M', '--machines', 'machines', is_flag=True,
+              help="Compares usage group by the machines merged with `tm merge`")
+@click.option('-H', '--host',
+              help="Only compares usage on this machine merged with `tm merge`, '' for this one")
+@click.option('-O', '--output',
+              type=click.Path(file_okay=True, dir_okay=True, writable=True, resolve_path=True),
+              help="Output json data to the specified file")
+def compare(ctx, tt, web, period, ranges, num, tags, machines, host, output):
+    """
+    Compare the time spent in two or more periods.
+
+    Add web to compare web sites.
+
+    Example:
+
+    \b
+    $ tm compare -m
+
+                         Last month   This month        Change\n
+        ──────────────────────────────────────────────────────\n
+              PyCharm   40h 12m 05s  52h 40m 13s  +12h 28m 08s  +31.0%\n
+        Google Chrome   30h 02m 45s  21h 10m 02s   -8h 52m 43s  -29.5%
+
+    $ tm compare web -r 2016-08-01:2016-08-31 -r 2016-09-01:2016-09-30
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    if ranges:
+        if len(ranges) < 2:
+            raise click.UsageError('Give at least two ranges to compare.')
+        periods = [_parse_range(r) for r in ranges]
+    else:
+        periods = _compare_periods(period, datetime.now())
+    if web is not None and web.lower() != 'web':
+        raise click.UsageError(
+            'Use `web` to compare web browsing statistics',
+        )
+    if tags:
+        name = 'domain_tag' if web else 'tag_name'
+    elif machines:
+        name = 'host'
+    elif web:
+        name = 'domain'
+    else:
+        name = 'app_name'
+    with tt.read_only():
+        rows = tt.compare([(start, end) for _, start, end in periods], name, host=host)
+    # applications without a tag are reported together
+    others = 'This Mac' if machines else 'Others'
+    labels = [label for label, _, _ in periods]
     if output:
+        records = [dict(zip([name] + labels, [row.name or others] + row.durations)) for row in rows[:num]]
         try:
             with open(output, 'w') as f:
                 json.dump(records, f)
@@ -196,24 +373,418 @@ def list(ctx, tt, web, start_, end_, week, month, day, num, tags, output):
             raise click.FileError(output, hint='IOError')
         else:
             click.echo(trackmac.utils.style('time', 'Successfully written to {}'.format(output)))
+        return
+    if not rows:
+        click.echo(trackmac.utils.style('time', 'No data being collected.Please wait for a moment.'))
+        return
+    totals = [sum(durations) for durations in zip(*[row.durations for row in rows])]
+    lines = [(row.name or others, row.durations) for row in rows[:num]] + [('Total', totals)]
+    max_len = max(len(line_name.encode("utf8")) for line_name, _ in lines)
+    width = max(len(label) for label in labels + ['000h 00m 00s'])
+    click.echo(trackmac.utils.style('date', u"\t{} {} {:>{width}}".format(
+        u' ' * max_len, u' '.join(u'{:>{}}'.format(label, width) for label in labels), 'Change', width=width + 1)))
+    click.echo(trackmac.utils.style('date', u"\t" + u"─" * (max_len + (width + 1) * (len(labels) + 1) + 8)))
+    for line_name, durations in lines:
+        change = durations[-1] - durations[0]
+        if durations[0]:
+            percentage = '{:+.1f}%'.format(100.0 * change / durations[0])
+        else:
+            percentage = 'new'
+        click.echo(u"\t{project} {times} {change} {percentage}".format(
+            project=trackmac.utils.style('project', trackmac.utils.fill_text_to_print_width(line_name, max_len)),
+            times=trackmac.utils.style('time', u' '.join(
+                u'{:>{}}'.format(trackmac.utils.format_timedelta(seconds), width) for seconds in durations)),
+            change=trackmac.utils.style('tag', u'{:>{}}'.format(
+                ('+' if change > 0 else '') + trackmac.utils.format_timedelta(change), width + 1)),
+            percentage=trackmac.utils.style('tag', '{:>7}'.format(percentage))
+        ))
+
+
+def _parse_range(value):
+    """
+    (label, start, end) of a 'from:to' range of dates, `to` inclusive
+    """
+    try:
+        start_, end_ = value.split(':')
+        start = datetime.strptime(start_, "%Y-%m-%d").date()
+        end = datetime.strptime(end_, "%Y-%m-%d").date() + timedelta(days=1)
+    except ValueError:
+        raise click.BadParameter('{!r} is not a range like 2016-09-01:2016-09-30'.format(value))
+    if start > end:
+        raise click.ClickException("'from' must be anterior to 'to'")
+    return '{} - {}'.format(start.strftime("%b %d"), (end - timedelta(days=1)).strftime("%b %d")), start, end
+
+
+def _compare_periods(period, now):
+    """
+    (label, start, end) of the period before and the current one, both up to the same point in time
+    """
+    start = trackmac.utils.get_start_date_for_period('week' if period == 'week' else 'month')
+    if period == 'week':
+        labels = ['Last week', 'This week']
+        before = start - timedelta(days=7), now - timedelta(days=7)
     else:
-        click.echo(trackmac.utils.style('date', "\t" + trackmac.utils.fill_text_to_print_width(
-            start_.strftime("%Y %b %d") + " - " + end.strftime("%Y %b %d"), max_len + 22)))
-        click.echo(trackmac.utils.style('date', "\t" + trackmac.utils.fill_text_to_print_width(u"─" * 29, max_len + 24)))
-        total_time = sum(r['duration'] for r in records)
-        for rec in records:
-            click.echo(u"\t{project} {time} {percentage}".format(
-                time=trackmac.utils.style('time', '{:>11}'.format(trackmac.utils.format_timedelta(rec['duration']))),
-                project=trackmac.utils.style(
-                    'project', trackmac.utils.fill_text_to_print_width((rec[name] or 'Others'), max_len)
-                ),
-                percentage=trackmac.utils.style('tag', trackmac.utils.get_progress(rec['duration'], total_time))
-            ))
+        months = 1 if period == 'month' else 12
+        labels = ['Last month', 'This month'] if period == 'month' else \
+            [trackmac.utils.shift_months(start, -12).strftime("%b %Y"), start.strftime("%b %Y")]
+        before = trackmac.utils.shift_months(start, -months), trackmac.utils.shift_months(now, -months)
+    return [(labels[0],) + before, (labels[1], start, now)]
+
+
+@cli.command()
+@pass_tracker
+@click.argument('web', required=False)
+@click.pass_context
+@click.option('-f', '--from', 'start_', type=str,
+              help="The first day to export.Format:%Y-%m-%d")
+@click.option('-t', '--to', 'end_', type=str,
+              help="The last day to export (inclusive).Format:%Y-%m-%d")
+@click.option('--format', 'format_', type=click.Choice(['ndjson', 'csv']), default='ndjson',
+              help='Output format(default to ndjson).')
+@click.option('--since-id', type=int,
+              help='Only export records with a larger id, changes by `tm compact` to older ones are missed.')
+@click.option('-O', '--output', default='-',
+              type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+              help="Write to the specified file instead of stdout")
+def export(ctx, tt, web, start_, end_, format_, since_id, output):
+    """
+    Export the raw track records.
+
+    Add web to export web browsing records. Records are written in id
+    order, the id of the last one can be passed to --since-id next time
+    to export only new records. Records merged by `tm compact` keep the
+    id of the first one, so --since-id misses those changes.
+
+    Example:
+
+    \b
+    $ tm export web -f 2016-09-01 --format csv -O web.csv
+    Exported 1523 records to web.csv, last id 1523.
+
+    $ tm export --since-id 1523 | gzip > normal.ndjson.gz
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    if web is not None and web.lower() != 'web':
+        raise click.UsageError('Use `web` to export web browsing records')
+    web = web is not None
+    start = start_ and datetime.strptime(start_, "%Y-%m-%d").date()
+    end = end_ and datetime.strptime(end_, "%Y-%m-%d").date() + timedelta(days=1)
+    columns = tt.export_columns(web)
+    count, last_id = 0, since_id
+    with tt.read_only(), click.open_file(output, 'w') as f:
+        if format_ == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            write = writer.writerow
+        else:
+            write = lambda row: f.write(trackmac.utils.ndjson_line(columns, row))
+        for row in tt.export(start, end, web, since_id):
+            write(row)
+            count += 1
+            last_id = row[0]
+    click.echo(trackmac.utils.style('time', 'Exported {} records to {}, last id {}.'.format(
+        count, 'stdout' if output == '-' else output, last_id)), err=True)
+
+
+@cli.command()
+@pass_tracker
+@click.pass_context
+@click.option('-g', '--gap', type=int, default=10,
+              help='Merge records of the same application or url at most this many seconds apart(default to 10).')
+@click.option('-k', '--keep', 'keep_days', type=int,
+              help='Archive records older than this many days, reports still show their daily usage.')
+@click.option('--archive/--no-archive', default=True,
+              help='Write archived records to a gzipped file or only keep their daily usage.')
+@click.option('--auto/--no-auto', default=None,
+              help='Let the daemon compact with these options once a day while you are away.')
+def compact(ctx, tt, gap, keep_days, archive, auto):
+    """
+    Shrink the database.
+
+    Records of a session split by short gaps are merged, records older
+    than --keep days are moved to the archive folder and the freed space
+    is given back.
+
+    Example:
+
+    \b
+    $ tm compact -k 90
+    Merged 20713 records, archived 180240 records, freed 21.3 MB.
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    if auto is not None:
+        tt.set_auto_compact(gap if auto else None, keep_days)
+        click.echo(trackmac.utils.style('time', 'Automatic compaction {}.'.format('on' if auto else 'off')))
+        return
+    stats = tt.compact(gap, keep_days, archive)
+    click.echo(trackmac.utils.style('time', 'Merged {merged} records, archived {archived} records, '
+                                            'freed {size:.1f} MB.'.format(size=stats['freed'] / 1024.0 / 1024,
+                                                                          **stats)))
+    for path in stats['archives']:
+        click.echo(u'Archived to {}'.format(path))
+
+
+@cli.command()
+@pass_tracker
+@click.pass_context
+@click.option('-f', '--from', 'start_', type=str,
+              default=(date.today() - timedelta(days=27)).strftime("%Y-%m-%d"),
+              help="The date from when the heatmap should start(default to 4 weeks ago).Format:%Y-%m-%d")
+@click.option('-t', '--to', 'end_', type=str,
+              default=date.today().strftime("%Y-%m-%d"),
+              help="The date at which the heatmap should stop (inclusive).Format:%Y-%m-%d")
+@click.option('-a', '--app', 'app_name',
+              help="Only count the time of this application")
+@click.option('-T', '--tag', 'tag_name',
+              help="Only count the time of applications with this tag")
+@click.option('-D', '--domain',
+              help="Only count the time on this web site, as shown by `tm list web`")
+@click.option('-H', '--host',
+              help="Only count the time on this machine merged with `tm merge`, '' for this one")
+@click.option('--format', 'format_', type=click.Choice(['grid', 'json']), default='grid',
+              help='Output format(default to grid).')
+@click.option('-O', '--output', default='-',
+              type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+              help="Write to the specified file instead of stdout")
+def heatmap(ctx, tt, start_, end_, app_name, tag_name, domain, host, format_, output):
+    """
+    Show when time is spent, per weekday and hour.
+
+    Example:
+
+    \b
+    $ tm heatmap -a PyCharm
+                2016 Aug 11 - 2016 Sep 07
+            0     3     6     9     12    15    18    21
+    Mon                     ▒▒████▓▓░░▓▓██▓▓▒▒             9h 41m 12s
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    start = datetime.strptime(start_, "%Y-%m-%d").date()
+    end = datetime.strptime(end_, "%Y-%m-%d").date() + timedelta(days=1)
+    if start > end:
+        raise click.ClickException("'from' must be anterior to 'to'")
+    with tt.read_only():
+        grid = tt.heatmap(start, end, app_name, tag_name, domain, host)
+    weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    with click.open_file(output, 'w') as f:
+        if format_ == 'json':
+            json.dump({'from': str(start), 'to': str(end - timedelta(days=1)), 'weekdays': weekdays,
+                       'hours': [hour for hour in range(24)], 'seconds': grid}, f)
+            f.write('\n')
+            return
+        peak = max(max(row) for row in grid)
+        if not peak:
+            click.echo(trackmac.utils.style('time', 'No data being collected.Please wait for a moment.'), file=f)
+            return
+        shades = u' ░▒▓█'
+        click.echo(trackmac.utils.style('date', u'\t    {} - {}'.format(
+            start.strftime("%Y %b %d"), (end - timedelta(days=1)).strftime("%Y %b %d"))), file=f)
+        click.echo(u'\t' + u''.join(u'{:<6}'.format(hour) for hour in range(0, 24, 3)), file=f)
+        levels = len(shades) - 1
+        for name, row in zip(weekdays, grid):
+            # the darkest shade is the busiest hour, any time at all gets the lightest, rounding up
+            cells = u''.join(shades[(levels * seconds + peak - 1) // peak] * 2 for seconds in row)
+            click.echo(u'{}\t{} {}'.format(trackmac.utils.style('project', name), trackmac.utils.style('tag', cells),
+                                           trackmac.utils.style('time', trackmac.utils.format_timedelta(sum(row)))),
+                       file=f)
+
+
+@cli.command()
+@pass_tracker
+@click.pass_context
+@click.option('-d', '--date', 'date_', type=str,
+              default=date.today().strftime("%Y-%m-%d"),
+              help="The day to show(default to today).Format:%Y-%m-%d")
+@click.option('-s', '--shorter', type=int, default=0,
+              help='Coalesce consecutive sessions shorter than this many seconds into one line.')
+@click.option('-H', '--host', default='',
+              help="Show the day on this machine merged with `tm merge` instead of this one")
+def timeline(ctx, tt, date_, shorter, host):
+    """
+    Show the sessions of a day in the order they happened.
+
+    Example:
+
+    \b
+    $ tm timeline -d 2016-09-07 -s 30
+        09:02:11 - 09:47:35      45m 24s PyCharm
+        09:47:35 - 09:49:02      01m 27s Google Chrome  GitHub https://github.com/
+        09:49:02 - 09:52:40      02m 53s Terminal       6 short sessions
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    day = datetime.strptime(date_, "%Y-%m-%d").date()
+    with tt.read_only():
+        empty = True
+        for row in tt.timeline(day, shorter, host):
+            empty = False
+            if row.sessions > 1:
+                detail = '{} short sessions'.format(row.sessions)
+            else:
+                detail = u' '.join(_ for _ in (row.title, row.domain) if _)
+            click.echo(u"\t{} - {} {} {}".format(
+                trackmac.utils.style('date', row.start.strftime("%H:%M:%S")),
+                trackmac.utils.style('date', row.end.strftime("%H:%M:%S")),
+                trackmac.utils.style('time', '{:>12}'.format(trackmac.utils.format_timedelta(row.duration))),
+                trackmac.utils.style('project', u'{:<14} '.format(row.app_name) if detail else row.app_name)) +
+                trackmac.utils.style('tag', detail))
+        if empty:
+            click.echo(trackmac.utils.style('time', 'No sessions on {}.'.format(day.strftime("%Y %b %d"))))
+
+
+@cli.command()
+@pass_tracker
+@click.argument('words', nargs=-1, required=True)
+@click.pass_context
+@click.option('-f', '--from', 'start_', type=str,
+              help="Only count the time from this date.Format:%Y-%m-%d")
+@click.option('-t', '--to', 'end_', type=str,
+              help="Only count the time up to this date (inclusive).Format:%Y-%m-%d")
+@click.option('-n', '--num', type=int, default=10,
+              help='Only show top n pages(default to 10).')
+def search(ctx, tt, words, start_, end_, num):
+    """
+    Find web pages by words of their title or url.
+
+    Example:
+
+    \b
+    $ tm search PROJ-123
+     2h 13m 05s PROJ-123 Login fails on Safari - JIRA
+                https://jira.example.com/browse/PROJ-123
+                2016-09-01 - 2016-09-07, 14 visits
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    start = start_ and datetime.strptime(start_, "%Y-%m-%d").date()
+    end = end_ and datetime.strptime(end_, "%Y-%m-%d").date() + timedelta(days=1)
+    with tt.read_only():
+        pages = tt.search(u' '.join(words), start, end, num)
+    if not pages:
+        click.echo(trackmac.utils.style('time', 'No web pages found.'))
+        return
+    for page in pages:
+        click.echo(u'{} {}'.format(trackmac.utils.style('time', '{:>11}'.format(
+            trackmac.utils.format_timedelta(page.duration))), trackmac.utils.style('project', page.title or '')))
+        click.echo(u'{:>11} {}'.format('', page.url))
+        click.echo(trackmac.utils.style('date', u'{:>11} {} - {}, {} visits'.format(
+            '', page.first.strftime('%Y-%m-%d'), page.last.strftime('%Y-%m-%d'), page.visits)))
+
+
+@cli.command()
+@pass_tracker
+@click.pass_context
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('-H', '--host',
+              help='Name of the machine the database comes from(default to the file name without extension).')
+def merge(ctx, tt, paths, host):
+    """
+    Merge databases of other machines.
+
+    Records already merged are skipped, so a newer copy of the
+    same database can be merged again. `tm list -M` reports the
+    time per machine, `tm list -H NAME` the time on one of them.
+
+    Example:
+
+    \b
+    $ tm merge ~/Dropbox/work-mac.db
+    Merged 180240 records and 12 applications from work-mac, skipped 3 records.
+    """
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    if host and len(paths) > 1:
+        raise click.UsageError('--host names a single database.')
+    hosts = [host or os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if len(set(hosts)) < len(hosts):
+        raise click.UsageError('The file names of the databases name their machines, they must differ.')
+    for path, name in zip(paths, hosts):
+        try:
+            stats = tt.merge(path, name)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(trackmac.utils.style('time', 'Merged {records} records and {applications} applications from '
+                                                '{host}, skipped {skipped} records.'.format(
+                                                    records=stats['normal'] + stats['web'], host=name, **stats)))
+        if stats['archived_days'] or stats['rolled_up']:
+            click.echo(trackmac.utils.style('time', 'Added the daily usage of {archived_days} days archived there '
+                                                    'and {rolled_up} records of days archived here.'.format(**stats)))
+
+
+@cli.command()
+@pass_tracker
+@click.pass_context
+@click.option('--on/--off', 'enable', default=None,
+              help='Turn the daemon metrics on or off, they are off by default.')
+def stats(ctx, tt, enable):
+    """
+    Show what the track daemon costs.
+
+    Example:
+
+    \b
+    $ tm stats
+    Daemon started 2016-09-07 09:12:03, updated 2016-09-07 18:40:55
+                ticks  34071  (2 missed, 0 probe stalls, 0 database errors)
+                 tick  p50 <= 0.5ms  p99 <= 5ms  (34071 times)
+    """
+    import trackmac.models
+    if not trackmac.utils.has_set_up():
+        click.echo(trackmac.utils.style('error', 'Could not find db or plist file.Run `tm setup` first.\n'))
+        ctx.abort()
+    if enable is not None:
+        tt.set_metrics(enable)
+        click.echo(trackmac.utils.style('time', 'Metrics turned {}.'.format('on' if enable else 'off')))
+        return
+    try:
+        data = trackmac.metrics.load(trackmac.models.metrics_file())
+    except (IOError, OSError, ValueError):
+        click.echo(trackmac.utils.style('error', 'No metrics written yet.The daemon writes them every minute '
+                                                 'while they are on(`tm stats --on`).'))
+        return
+    counters, histograms = data['counters'], data['histograms']
+
+    def latency(seconds):
+        if seconds is None:
+            return '>5s'
+        return '<= {:g}ms'.format(seconds * 1000) if seconds < 1 else '<= {:g}s'.format(seconds)
+
+    click.echo(trackmac.utils.style('date', u'Daemon started {}, updated {}'.format(
+        data['started'][:19].replace('T', ' '), data['updated'][:19].replace('T', ' '))))
+    ticks = counters.get('ticks', 0)
+    click.echo(u'{:>17}  {}  ({} missed, {} probe stalls, {} database errors)'.format(
+        'ticks', trackmac.utils.style('time', ticks), counters.get('missed_ticks', 0),
+        counters.get('probe_stalls', 0), counters.get('db_errors', 0)))
+    for name, label in [('tick_seconds', 'tick'), ('probe_seconds', 'frontmost app'),
+                        ('tab_seconds', 'browser tab'), ('flush_seconds', 'database write')]:
+        h = histograms[name]
+        if h.count:
+            click.echo(u'{:>17}  p50 {}  p99 {}  ({} times)'.format(
+                label, trackmac.utils.style('time', latency(h.quantile(0.5))),
+                trackmac.utils.style('time', latency(h.quantile(0.99))), h.count))
+    h = histograms['statements_per_tick']
+    if h.count:
+        click.echo(u'{:>17}  {:.2f} per tick, p99 <= {}, {} commits'.format(
+            'statements', h.total / float(h.count), h.quantile(0.99), counters.get('commits', 0)))
+    sizes = data['db_sizes']
+    if sizes:
+        growth = trackmac.metrics.growth_per_day(sizes)
+        click.echo(u'{:>17}  {:.1f} MB{}'.format('database', sizes[-1][1] / 1024.0 / 1024, '' if growth is None else
+                                                 ', growing {:.1f} KB a day'.format(growth / 1024.0)))
 
 
 @cli.command()
 @click.argument('app_name', required=False)
-@click.pass_obj
+@pass_tracker
 @click.pass_context
 @click.option('-d', '--delete', type=str,
               help='Remove blocked application')
@@ -245,21 +816,53 @@ def block(ctx, tt, app_name, delete):
 @cli.command()
 @click.option('-a', '--add', 'param', nargs=2, type=click.STRING,
               help='the tag to add', required=False)
-@click.pass_obj
+@click.option('-r', '--rule', nargs=2, type=click.STRING,
+              help='the tag and a glob of the applications it is given to', required=False)
+@click.option('-w', '--web', is_flag=True,
+              help='the rule matches web sites instead of applications')
+@click.option('-e', '--regex', is_flag=True,
+              help='the pattern of the rule is a regular expression instead of a glob')
+@click.option('-d', '--delete', type=int,
+              help='delete the rule with this number')
+@pass_tracker
 @click.pass_context
-def tag(ctx, tt, param):
+def tag(ctx, tt, param, rule, web, regex, delete):
     """
     Add a new tag for grouping applications.
 
+    Rules tag all applications or web sites matching a pattern. A web site
+    rule wins over the tag of the browser, which wins over application rules.
+
     example:
 
+    \b
     $ tm tag -a Developing Pycharm
+    $ tm tag -r Developing 'JetBrains*'
+    $ tm tag -r Playing '*.youtube.com' -w
+    $ tm tag -r Reading '(medium|substack)[.]com$' -w -e
+    $ tm tag -d 2
 
     """
-    if not param:
+    if rule:
+        try:
+            rule_id = tt.add_tag_rule(rule[0], rule[1], 'domain' if web else 'app', regex)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--rule')
+        click.echo(trackmac.utils.style('time', 'Successfully added rule {}.'.format(rule_id)))
+    elif delete is not None:
+        if tt.delete_tag_rule(delete):
+            click.echo(trackmac.utils.style('time', 'Successfully deleted rule {}.'.format(delete)))
+        else:
+            click.echo(trackmac.utils.style('error', 'Rule {} not found.'.format(delete)))
+    elif not param:
         for t in tt.tags:
             click.echo(u"\t{tag}\n \t\t[{apps}]".format(tag=trackmac.utils.style('tag', t['tag_name']),
                                                         apps=trackmac.utils.style('project', t['app_names'])))
+        for r in tt.tag_rules:
+            click.echo(u"\t{id:>3} {tag} {kind} {pattern}".format(
+                id=r.id, tag=trackmac.utils.style('tag', r.tag_name),
+                kind='web' if r.kind == 'domain' else 'app',
+                pattern=trackmac.utils.style('project', u'/{}/'.format(r.pattern) if r.regex else r.pattern)))
     elif tt.add_tag(*param):
         click.echo(trackmac.utils.style('time', 'Successfully added tag.'))
     else:
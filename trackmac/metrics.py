@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Self metrics of the daemon.
+
+Counters and fixed-bucket histograms are kept in memory and written to a
+small json file every METRICS_INTERVAL seconds, `tm stats` reads it.
+"""
+import os
+import json
+import bisect
+import datetime
+try:
+    from time import perf_counter as timer
+except ImportError:
+    from time import time as timer
+
+# upper bounds of the latency buckets in seconds, the last bucket takes everything above
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+# days of database sizes kept for the growth per day
+SIZE_HISTORY = 30
+
+
+class Histogram(object):
+    """
+    Number of observations per bucket, bucket i holds values up to buckets[i]
+    """
+
+    def __init__(self, buckets, counts=None, total=0):
+        self.buckets = tuple(buckets)
+        self.counts = list(counts or [0] * (len(self.buckets) + 1))
+        self.total = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """
+        upper bound of the bucket holding the q-quantile, None above the last bucket or without observations
+        """
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else None
+        return None
+
+    def to_dict(self):
+        return {'buckets': self.buckets, 'counts': self.counts, 'total': self.total}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['buckets'], d['counts'], d['total'])
+
+
+class Metrics(object):
+    """
+    Counters and histograms of one daemon run
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.started = datetime.datetime.now()
+        self.counters = {}
+        self.histograms = {
+            'tick_seconds': Histogram(LATENCY_BUCKETS),
+            'probe_seconds': Histogram(LATENCY_BUCKETS),
+            'tab_seconds': Histogram(LATENCY_BUCKETS),
+            'flush_seconds': Histogram(LATENCY_BUCKETS),
+            'statements_per_tick': Histogram(COUNT_BUCKETS),
+        }
+        # [day, bytes] of the database, one per day
+        self.db_sizes = []
+        self.last_write = timer()
+        if os.path.exists(path):
+            try:
+                self.db_sizes = load(path).get('db_sizes', [])
+            except ValueError:
+                pass
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def due(self):
+        return timer() - self.last_write >= self.interval
+
+    def write(self, counters, db_file):
+        """
+        write the metrics together with `counters` kept elsewhere, e.g. by the probe
+        """
+        self.last_write = timer()
+        today = datetime.date.today().isoformat()
+        size = os.path.getsize(db_file) if os.path.exists(db_file) else 0
+        if self.db_sizes and self.db_sizes[-1][0] == today:
+            self.db_sizes[-1][1] = size
+        else:
+            self.db_sizes = (self.db_sizes + [[today, size]])[-SIZE_HISTORY:]
+        data = {
+            'pid': os.getpid(),
+            'started': self.started.isoformat(),
+            'updated': datetime.datetime.now().isoformat(),
+            'counters': dict(self.counters, **counters),
+            'histograms': dict((name, h.to_dict()) for name, h in self.histograms.items()),
+            'db_sizes': self.db_sizes,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        # readers never see a half written file
+        os.rename(tmp_path, self.path)
+
+
+def load(path):
+    with open(path) as f:
+        data = json.load(f)
+    data['histograms'] = dict((name, Histogram.from_dict(h)) for name, h in data['histograms'].items())
+    return data
+
+
+def growth_per_day(db_sizes):
+    """
+    average bytes the database grew by per day
+    """
+    if len(db_sizes) < 2:
+        return None
+    first, last = db_sizes[0], db_sizes[-1]
+    days = (datetime.datetime.strptime(last[0], '%Y-%m-%d') - datetime.datetime.strptime(first[0], '%Y-%m-%d')).days
+    return (last[1] - first[1]) / float(days) if days else None
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Schema migrations.
+
+The number of applied steps is stored in `PRAGMA user_version`. New steps
+must be appended to MIGRATIONS and never reordered. A step only knows the
+schema of its own version, so it names the tables, columns and indexes it
+touches instead of relying on the models, which describe the latest schema.
+"""
+import peewee
+
+import trackmac.utils
+from trackmac.models import db, Application, NormalTrackRecord, WebTrackRecord, DailyUsage, TrackState, \
+    OPEN_RECORD_KEYS, LONGEST_RECORD_KEY, MODELS
+
+
+def add_index(model, columns, unique=False):
+    """
+    create an index named the way peewee names model indexes
+    """
+    db.execute_sql('CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+        'UNIQUE ' if unique else '', '_'.join([model._meta.table_name] + columns), model._meta.table_name,
+        ', '.join('"{}"'.format(c) for c in columns)))
+
+
+def create_track_state():
+    """
+    create the tables missing from databases of older versions
+    """
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "trackstate" '
+                   '("name" VARCHAR(255) NOT NULL PRIMARY KEY, "value" INTEGER)')
+
+
+def move_is_current_flags():
+    """
+    point TrackState at the record flagged `is_current` and clear the flags
+    """
+    for model, key in OPEN_RECORD_KEYS.items():
+        current = model.select(model.id).where(model.is_current == True).order_by(model.id.desc()).first()
+        if current is None:
+            continue
+        if not TrackState.select().where(TrackState.name << list(OPEN_RECORD_KEYS.values())).exists():
+            TrackState.insert(name=key, value=current.id).execute()
+        model.update(is_current=False).where(model.is_current == True).execute()
+
+
+def create_indexes():
+    """
+    indexes used by reports and `tm block`
+    """
+    add_index(Application, ['app_name'])
+    for model in (NormalTrackRecord, WebTrackRecord):
+        add_index(model, ['app_id'])
+        add_index(model, ['start_datetime', 'app_id'])
+
+
+def create_daily_usage():
+    """
+    daily rollup used by reports, filled from the existing records
+    """
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "dailyusage" ('
+                   '"id" INTEGER NOT NULL PRIMARY KEY, "day" DATE NOT NULL, "app_id" INTEGER NOT NULL, '
+                   '"domain" VARCHAR(255) NOT NULL, "seconds" INTEGER NOT NULL, '
+                   'FOREIGN KEY ("app_id") REFERENCES "application" ("id"))')
+    add_index(DailyUsage, ['app_id'])
+    add_index(DailyUsage, ['day', 'app_id', 'domain'], unique=True)
+    db.execute_sql('INSERT INTO "dailyusage" ("day", "app_id", "domain", "seconds") '
+                   'SELECT date("start_datetime"), "app_id", \'\', SUM("duration") FROM "normaltrackrecord" '
+                   'GROUP BY 1, 2')
+    db.execute_sql('INSERT INTO "dailyusage" ("day", "app_id", "domain", "seconds") '
+                   'SELECT date("start_datetime"), "app_id", url_domain("url"), SUM("duration") '
+                   'FROM "webtrackrecord" GROUP BY 1, 2, 3')
+
+
+def add_web_domain():
+    """
+    store the domain of web records instead of parsing the url in every report
+    """
+    db.execute_sql('ALTER TABLE "webtrackrecord" ADD COLUMN "domain" VARCHAR(255)')
+    db.execute_sql('UPDATE "webtrackrecord" SET "domain" = url_domain("url")')
+    add_index(WebTrackRecord, ['domain'])
+
+
+def split_daily_usage():
+    """
+    count records running past midnight on the days they were spent on instead of the day they started
+    """
+    for table, domain in (('normaltrackrecord', "''"), ('webtrackrecord', '"domain"')):
+        cursor = db.execute_sql('SELECT "app_id", {}, "start_datetime", "end_datetime", "duration" FROM "{}" '
+                                'WHERE "end_datetime" > datetime(date("start_datetime"), \'+1 day\')'.format(domain,
+                                                                                                          table))
+        for app_id, rec_domain, start, end, duration in cursor.fetchall():
+            start = peewee.format_date_time(start, peewee.DateTimeField.formats)
+            end = peewee.format_date_time(end, peewee.DateTimeField.formats)
+            split = [(start.date(), -duration)] + trackmac.utils.split_by_day(start, end, duration)
+            for day, seconds in split:
+                db.execute_sql('INSERT INTO "dailyusage" ("day", "app_id", "domain", "seconds") VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT ("day", "app_id", "domain") '
+                               'DO UPDATE SET "seconds" = "seconds" + "excluded"."seconds"',
+                               (day.strftime('%Y-%m-%d'), app_id, rec_domain or '', seconds))
+    db.execute_sql('DELETE FROM "dailyusage" WHERE "seconds" <= 0')
+
+
+def intern_urls_and_titles():
+    """
+    store every url and title once and refer to them by id from the web records
+    """
+    for table, column in (('pageurl', 'url'), ('pagetitle', 'title')):
+        db.execute_sql('CREATE TABLE IF NOT EXISTS "{0}" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                       '"{1}" VARCHAR(255) NOT NULL)'.format(table, column))
+        db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}")'.format(table, column))
+        db.execute_sql('INSERT OR IGNORE INTO "{0}" ("{1}") SELECT DISTINCT "{1}" FROM "webtrackrecord" '
+                       'WHERE "{1}" IS NOT NULL'.format(table, column))
+    # sqlite cannot change the type of a column, the table is copied
+    db.execute_sql('CREATE TABLE "webtrackrecord_new" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                   '"app_id" INTEGER NOT NULL, "start_datetime" DATETIME NOT NULL, '
+                   '"end_datetime" DATETIME NOT NULL, "duration" INTEGER NOT NULL, "title_id" INTEGER, '
+                   '"url_id" INTEGER NOT NULL, "domain" VARCHAR(255), "is_current" INTEGER NOT NULL, '
+                   'FOREIGN KEY ("app_id") REFERENCES "application" ("id"), '
+                   'FOREIGN KEY ("title_id") REFERENCES "pagetitle" ("id"), '
+                   'FOREIGN KEY ("url_id") REFERENCES "pageurl" ("id"))')
+    db.execute_sql('INSERT INTO "webtrackrecord_new" SELECT w."id", w."app_id", w."start_datetime", '
+                   'w."end_datetime", w."duration", t."id", u."id", w."domain", w."is_current" '
+                   'FROM "webtrackrecord" AS w JOIN "pageurl" AS u ON u."url" = w."url" '
+                   'LEFT OUTER JOIN "pagetitle" AS t ON t."title" = w."title"')
+    db.execute_sql('DROP TABLE "webtrackrecord"')
+    db.execute_sql('ALTER TABLE "webtrackrecord_new" RENAME TO "webtrackrecord"')
+    add_index(WebTrackRecord, ['app_id'])
+    add_index(WebTrackRecord, ['domain'])
+    add_index(WebTrackRecord, ['start_datetime', 'app_id'])
+
+
+def add_hosts():
+    """
+    tell records merged from other machines apart, in the records and the daily rollup
+    """
+    for table in ('normaltrackrecord', 'webtrackrecord', 'dailyusage'):
+        db.execute_sql('ALTER TABLE "{}" ADD COLUMN "host" VARCHAR(255) NOT NULL DEFAULT \'\''.format(table))
+    db.execute_sql('DROP INDEX "dailyusage_day_app_id_domain"')
+    add_index(DailyUsage, ['day', 'app_id', 'domain', 'host'], unique=True)
+
+
+def create_page_search():
+    """
+    full text index over the urls and titles of web records, kept up to date by triggers.
+    without the fts5 module `tm search` falls back to scanning them.
+    """
+    for table, column in (('pageurl', 'url'), ('pagetitle', 'title')):
+        try:
+            db.execute_sql('CREATE VIRTUAL TABLE "{0}_search" USING fts5("{1}", content="{0}", '
+                           'content_rowid="id")'.format(table, column))
+        except peewee.OperationalError:
+            return
+        db.execute_sql('CREATE TRIGGER "{0}_search_insert" AFTER INSERT ON "{0}" BEGIN '
+                       'INSERT INTO "{0}_search" ("rowid", "{1}") VALUES (new."id", new."{1}"); END'.format(table,
+                                                                                                              column))
+        db.execute_sql('CREATE TRIGGER "{0}_search_delete" AFTER DELETE ON "{0}" BEGIN '
+                       'INSERT INTO "{0}_search" ("{0}_search", "rowid", "{1}") '
+                       'VALUES (\'delete\', old."id", old."{1}"); END'.format(table, column))
+        db.execute_sql('INSERT INTO "{0}_search" ("{0}_search") VALUES (\'rebuild\')'.format(table))
+
+
+def create_tag_rules():
+    """
+    tag rules matching applications and web sites by pattern
+    """
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "tagrule" ("id" INTEGER NOT NULL PRIMARY KEY, '
+                   '"tag_name" VARCHAR(255) NOT NULL, "kind" VARCHAR(255) NOT NULL, '
+                   '"pattern" VARCHAR(255) NOT NULL, "regex" INTEGER NOT NULL)')
+
+
+
+def store_longest_record():
+    """
+    the length of the longest record, which bounds the records `overlapping` a range
+    """
+    for table in ('normaltrackrecord', 'webtrackrecord'):
+        TrackState.maximize(LONGEST_RECORD_KEY, db.execute_sql(
+            'SELECT MAX(strftime(\'%s\', "end_datetime") - strftime(\'%s\', "start_datetime")) FROM "{}"'.format(
+                table)).fetchone()[0])
+
+
+MIGRATIONS = [
+    create_track_state,
+    move_is_current_flags,
+    create_indexes,
+    create_daily_usage,
+    add_web_domain,
+    split_daily_usage,
+    intern_urls_and_titles,
+    add_hosts,
+    create_page_search,
+    create_tag_rules,
+    store_longest_record,
+]
+
+
+def current_version():
+    return db.user_version
+
+
+def migrate():
+    """
+    apply pending migrations in order and return the names of the applied steps
+    """
+    version = db.user_version
+    if version == 0 and not db.table_exists(Application._meta.table_name):
+        # brand new database, the models already describe the latest schema
+        with db.atomic():
+            db.create_tables(MODELS)
+            # virtual tables and triggers are not described by the models
+            create_page_search()
+            db.user_version = len(MIGRATIONS)
+        return []
+    applied = []
+    for number, step in enumerate(MIGRATIONS[version:], version + 1):
+        with db.atomic():
+            step()
+            db.user_version = number
+        applied.append(step.__name__)
+    return applied
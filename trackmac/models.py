@@ -1,9 +1,52 @@
 from peewee import *
+import os
 import datetime
+import contextlib
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 import trackmac.config
+import trackmac.utils
 
-db = SqliteDatabase(trackmac.config.TRACK_DB_FILE)
+# pragmas of every connection, the daemon writes every flush while reports read
+READ_PRAGMAS = (
+    ('cache_size', -1024 * 16),  # 16MB
+    ('mmap_size', 1024 * 1024 * 256),
+    ('busy_timeout', 10 * 1000),
+)
+# WAL lets readers and the writer work at the same time, NORMAL sync is durable enough with WAL
+PRAGMAS = (
+    # only takes effect on new databases, `tm compact` converts older ones
+    ('auto_vacuum', 'incremental'),
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+) + READ_PRAGMAS
+
+
+class TrackDatabase(SqliteDatabase):
+    """
+    SqliteDatabase counting the statements it executes and the transactions it commits
+    """
+    statements = 0
+    commits = 0
+
+    def execute_sql(self, sql, params=None):
+        self.statements += 1
+        if not self.in_transaction() and not sql.startswith(('SELECT', 'PRAGMA')):
+            # a statement out of a transaction commits by itself
+            self.commits += 1
+        return super(TrackDatabase, self).execute_sql(sql, params)
+
+    def commit(self):
+        self.commits += 1
+        return super(TrackDatabase, self).commit()
+
+
+db = TrackDatabase(trackmac.config.TRACK_DB_FILE, pragmas=PRAGMAS, timeout=10)
+# used by queries grouping web records by site
+db.register_function(trackmac.utils.url_domain, 'url_domain', 1)
 
 
 class BaseModel(Model):
@@ -12,7 +55,7 @@ class BaseModel(Model):
 
 
 class Application(BaseModel):
-    app_name = CharField()
+    app_name = CharField(index=True)
     tag_name = CharField(null=True)
 
 
@@ -24,7 +67,29 @@ class NormalTrackRecord(BaseModel):
     start_datetime = DateTimeField(default=datetime.datetime.now)
     end_datetime = DateTimeField(default=datetime.datetime.now)
     duration = IntegerField(default=1)
-    is_current = BooleanField(default=True)
+    # superseded by TrackState, kept so old databases stay readable
+    is_current = BooleanField(default=False)
+    # machine the record was merged from by `tm merge`, empty for this one
+    host = CharField(default='')
+
+    class Meta:
+        indexes = (
+            (('start_datetime', 'app'), False),
+        )
+
+
+class PageUrl(BaseModel):
+    """
+    Urls of web records, each stored once
+    """
+    url = CharField(unique=True)
+
+
+class PageTitle(BaseModel):
+    """
+    Titles of web records, each stored once
+    """
+    title = CharField(unique=True)
 
 
 class WebTrackRecord(BaseModel):
@@ -35,9 +100,102 @@ class WebTrackRecord(BaseModel):
     start_datetime = DateTimeField(default=datetime.datetime.now)
     end_datetime = DateTimeField(default=datetime.datetime.now)
     duration = IntegerField(default=1)
-    title = CharField(null=True)  # can be null when web page not fully loaded
-    url = CharField()
-    is_current = BooleanField(default=True)
+    # can be null when web page not fully loaded
+    title = ForeignKeyField(PageTitle, null=True, index=False, related_name='records')
+    url = ForeignKeyField(PageUrl, index=False, related_name='records')
+    # scheme and host of the url, e.g. https://github.com/
+    domain = CharField(null=True, index=True)
+    # superseded by TrackState, kept so old databases stay readable
+    is_current = BooleanField(default=False)
+    # machine the record was merged from by `tm merge`, empty for this one
+    host = CharField(default='')
+
+    class Meta:
+        indexes = (
+            (('start_datetime', 'app'), False),
+        )
+
+
+class DailyUsage(BaseModel):
+    """
+    Seconds spent per day, application and web site, kept up to date by the daemon
+    """
+    day = DateField()
+    app = ForeignKeyField(Application, related_name='daily_usage')
+    # empty for applications other than web browsers
+    domain = CharField(default='')
+    seconds = IntegerField(default=0)
+    host = CharField(default='')
+
+    class Meta:
+        indexes = (
+            (('day', 'app', 'domain', 'host'), True),
+        )
+
+    @classmethod
+    def add(cls, day, app_id, domain, seconds, host=''):
+        """
+        add seconds to the row of the given day, app, domain and host
+        """
+        cls.insert(day=day, app=app_id, domain=domain, seconds=seconds, host=host).on_conflict(
+            conflict_target=[cls.day, cls.app, cls.domain, cls.host],
+            update={cls.seconds: cls.seconds + EXCLUDED.seconds}).execute()
+
+    @classmethod
+    def rebuild(cls, start=None, end=None):
+        """
+        recompute the days from start (inclusive) to end (exclusive) from the records, all days by default
+        """
+        # records of archived days are gone, their rollup is all that is left
+        archived_before = TrackState.get_value('archived_before')
+        if archived_before:
+            archived_before = datetime.date.fromordinal(archived_before)
+            start = max(start, archived_before) if start else archived_before
+        with db.atomic():
+            delete = cls.delete()
+            if start:
+                delete = delete.where(cls.day >= start)
+            if end:
+                delete = delete.where(cls.day < end)
+            delete.execute()
+            for model in (NormalTrackRecord, WebTrackRecord):
+                cls.add_records(model, start, end)
+
+    @classmethod
+    def add_records(cls, model, start=None, end=None, after_id=None):
+        """
+        add the seconds of the records of the model to the days from start (inclusive) to end (exclusive),
+        only the records with ids above `after_id` if given
+        """
+        day = fn.date(model.start_datetime)
+        next_day = fn.datetime(day, '+1 day')
+        domain = model.domain if model is WebTrackRecord else Value('')
+        # records within one day, nearly all of them
+        query = model.select(day, model.app, domain, model.host, fn.SUM(model.duration)).\
+            where(model.end_datetime <= next_day)
+        if start:
+            query = query.where(model.start_datetime >= start)
+        if end:
+            query = query.where(model.start_datetime < end)
+        if after_id is not None:
+            query = query.where(model.id > after_id)
+        cls.insert_from(query.group_by(day, model.app, domain, model.host),
+                        [cls.day, cls.app, cls.domain, cls.host, cls.seconds]).on_conflict(
+            conflict_target=[cls.day, cls.app, cls.domain, cls.host],
+            update={cls.seconds: cls.seconds + EXCLUDED.seconds}).execute()
+        # records running past midnight are split by day
+        query = model.select(model.app, domain, model.host, model.start_datetime, model.end_datetime,
+                             model.duration).where(model.end_datetime > next_day)
+        if start:
+            query = query.where(model.end_datetime > start)
+        if end:
+            query = query.where(model.start_datetime < end)
+        if after_id is not None:
+            query = query.where(model.id > after_id)
+        for app_id, rec_domain, host, rec_start, rec_end, duration in query.tuples():
+            for rec_day, seconds in trackmac.utils.split_by_day(rec_start, rec_end, duration):
+                if (not start or rec_day >= start) and (not end or rec_day < end):
+                    cls.add(rec_day, app_id, rec_domain, seconds, host)
 
 
 class BlockedApplication(BaseModel):
@@ -45,3 +203,172 @@ class BlockedApplication(BaseModel):
     App not track
     """
     name = CharField()
+
+
+class TagRule(BaseModel):
+    """
+    Tag of the applications or web sites matching a pattern, see `trackmac.tagging`
+    """
+    tag_name = CharField()
+    # 'app' or 'domain'
+    kind = CharField()
+    pattern = CharField()
+    # the pattern is a regular expression instead of a glob
+    regex = BooleanField(default=False)
+
+
+class TrackState(BaseModel):
+    """
+    Daemon state, e.g. the id of the record currently open
+    """
+    name = CharField(primary_key=True)
+    value = IntegerField(null=True)
+
+    @classmethod
+    def get_value(cls, name, default=None):
+        state = cls.get_or_none(cls.name == name)
+        return default if state is None or state.value is None else state.value
+
+    @classmethod
+    def set_value(cls, name, value):
+        """
+        store the value of the state, None removes it
+        """
+        if value is None:
+            cls.delete().where(cls.name == name).execute()
+        else:
+            cls.insert(name=name, value=value).on_conflict_replace().execute()
+
+    @classmethod
+    def increment(cls, name):
+        cls.insert(name=name, value=1).on_conflict(
+            conflict_target=[cls.name], update={cls.value: cls.value + 1}).execute()
+
+    @classmethod
+    def maximize(cls, name, value):
+        """
+        store the value unless a bigger one is stored already, None is ignored
+        """
+        if value is not None:
+            cls.insert(name=name, value=value).on_conflict(
+                conflict_target=[cls.name], update={cls.value: fn.MAX(cls.value, EXCLUDED.value)}).execute()
+
+
+# TrackState name of the most seconds any record runs from its start to its end, rounded up
+# by the daemon. writers of records raise it, `overlapping` looks back that far before a range.
+LONGEST_RECORD_KEY = 'longest_record'
+
+
+def store_longest_record(model, after_id=None):
+    """
+    raise the longest record state to the longest record of the model, of the ids above `after_id` if given
+    """
+    query = model.select(fn.MAX(fn.strftime('%s', model.end_datetime) - fn.strftime('%s', model.start_datetime)))
+    if after_id is not None:
+        query = query.where(model.id > after_id)
+    TrackState.maximize(LONGEST_RECORD_KEY, query.scalar())
+
+
+def seconds_before(model, t):
+    """
+    sql version of `trackmac.utils.seconds_before` for the records of the model,
+    t is a datetime or an sql expression of one. `model` can also be the columns of a
+    query with the same names, e.g. of a common table expression.
+    """
+    if isinstance(t, datetime.datetime):
+        t = t.strftime('%Y-%m-%d %H:%M:%S')
+    return Case(None, [(model.start_datetime >= t, 0), (model.end_datetime <= t, model.duration)],
+                fn.MIN(model.duration, fn.MAX(0, fn.strftime('%s', t) - fn.strftime('%s', model.start_datetime))))
+
+
+def clipped_duration(model, start, end):
+    """
+    seconds of the records of the model spent from start to end
+    """
+    return seconds_before(model, end) - seconds_before(model, start)
+
+
+def overlapping(model, start, end):
+    """
+    records of the model running at some time from start to end. none of them starts earlier than
+    the longest record before start, so only that part of the start index is scanned however long
+    the history is. without the state, e.g. before the first record, there is no such bound.
+    """
+    start = start.strftime('%Y-%m-%d %H:%M:%S')
+    longest = TrackState.select(TrackState.value).where(TrackState.name == LONGEST_RECORD_KEY)
+    earliest = fn.COALESCE(fn.datetime(start, Value('-').concat(longest).concat(' seconds')), '')
+    return (model.start_datetime >= earliest) & (model.start_datetime < end.strftime('%Y-%m-%d %H:%M:%S')) & \
+        (model.end_datetime >= start)
+
+
+# TrackState names pointing at the open record of each table
+OPEN_RECORD_KEYS = {
+    NormalTrackRecord: 'open_normal_record',
+    WebTrackRecord: 'open_web_record',
+}
+
+MODELS = [Application, NormalTrackRecord, PageUrl, PageTitle, WebTrackRecord, BlockedApplication, TrackState, DailyUsage,
+          TagRule]
+
+
+# kept next to the database it caches, see `report_cache`
+cache_db = SqliteDatabase(None, pragmas=(('busy_timeout', 10 * 1000),), timeout=10)
+
+
+class ReportCache(Model):
+    """
+    Reports over days that do not change any more. Operations changing past data
+    increment the `generation` state of the tracked database, which turns all entries stale.
+    """
+    key = CharField(primary_key=True)
+    generation = IntegerField()
+    rows = TextField()
+
+    class Meta:
+        database = cache_db
+
+    @classmethod
+    def store(cls, key, generation, rows, keep=500):
+        """
+        add an entry, drop the stale ones and all but the `keep` newest
+        """
+        with cache_db.atomic():
+            cls.insert(key=key, generation=generation, rows=rows).on_conflict_replace().execute()
+            cls.delete().where(cls.generation != generation).execute()
+            newest = cls.select(SQL('rowid')).order_by(SQL('rowid').desc()).limit(keep)
+            cls.delete().where(SQL('rowid').not_in(newest)).execute()
+
+
+@contextlib.contextmanager
+def report_cache():
+    """
+    open the report cache of the tracked database
+    """
+    path = os.path.join(os.path.dirname(db.database), 'report_cache.db')
+    if cache_db.database != path:
+        cache_db.init(path)
+        cache_db.create_tables([ReportCache], safe=True)
+    yield cache_db
+
+
+def metrics_file():
+    """
+    metrics the daemon writes for `tm stats`, kept next to the tracked database
+    """
+    return os.path.join(os.path.dirname(db.database), 'metrics.json')
+
+
+@contextlib.contextmanager
+def read_only():
+    """
+    run the queries of the block on a separate read-only connection,
+    so a long report can never hold a lock the daemon waits for
+    """
+    ro_db = SqliteDatabase('file:{}?mode=ro'.format(pathname2url(db.database)), uri=True,
+                           pragmas=READ_PRAGMAS, timeout=10)
+    ro_db.register_function(trackmac.utils.url_domain, 'url_domain', 1)
+    try:
+        with ro_db.bind_ctx(MODELS):
+            yield ro_db
+    finally:
+        ro_db.close()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Activity probes and clocks used by the tracking loop.
+
+The daemon samples the desktop through CocoaProbe. ReplayProbe together
+with VirtualClock replays a scripted stream of samples without sleeping,
+e.g. a month of tracking on a build agent:
+
+    clock = VirtualClock(datetime.datetime(2016, 9, 1))
+    probe = ReplayProbe.from_script([(3600, 'PyCharm', None, None),
+                                     (600, 'Google Chrome', 'GitHub', 'https://github.com/')] * 24 * 30)
+    TimeTracking(probe=probe, clock=clock).start()
+"""
+import json
+import time
+import datetime
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+class ProbeExhausted(Exception):
+    """
+    raised by a probe with no more samples, stops the tracking loop
+    """
+
+
+class Probe(object):
+    """
+    Source of activity samples. The loop enters the probe once and calls
+    `frontmost_application` every tick, `current_tab` only for browsers.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def frontmost_application(self):
+        """
+        name of the frontmost application or None
+        """
+        raise NotImplementedError
+
+    def current_tab(self, browser_name):
+        """
+        title and url of the active tab of the browser, both can be None
+        """
+        return None, None
+
+
+class CocoaProbe(Probe):
+    """
+    Sample the desktop through the Cocoa frameworks
+    """
+
+    def __init__(self):
+        self.pool = None
+
+    @property
+    def cocoa(self):
+        import trackmac.cocoa
+        return trackmac.cocoa
+
+    def __enter__(self):
+        # To prevent memory leakage
+        self.pool = self.cocoa.NSAutoreleasePool()
+        self.pool.alloc()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.drain()
+
+    def frontmost_application(self):
+        app_name = self.cocoa.frontmost_application()
+        return app_name and app_name.decode('utf8')
+
+    def current_tab(self, browser_name):
+        # may run on the worker thread of a TimedProbe, which has no pool of its own
+        with self.cocoa.NSAutoreleasePool():
+            title, url = self.cocoa.current_tab(browser_name)
+        return title and title.decode('utf8'), url and url.decode('utf8')
+
+
+class ReplayProbe(Probe):
+    """
+    Replay a stream of (app, title, url) samples, one per tick
+    """
+
+    def __init__(self, samples, tab_latency=0):
+        self.samples = iter(samples)
+        self.sample = None
+        # seconds every `current_tab` call blocks, like a busy browser
+        self.tab_latency = tab_latency
+
+    @classmethod
+    def from_script(cls, script, tab_latency=0):
+        """
+        expand (seconds, app, title, url) segments into one sample per second
+        """
+        return cls(((app, title, url) for seconds, app, title, url in script for _ in range(int(seconds))),
+                   tab_latency)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        read recorded samples, one json object with `app`, `title` and `url` per line
+        """
+        def samples():
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        sample = json.loads(line)
+                        yield sample.get('app'), sample.get('title'), sample.get('url')
+        return cls(samples())
+
+    def frontmost_application(self):
+        try:
+            self.sample = next(self.samples)
+        except StopIteration:
+            raise ProbeExhausted()
+        return self.sample[0]
+
+    def current_tab(self, browser_name):
+        sample = self.sample
+        if self.tab_latency:
+            time.sleep(self.tab_latency)
+        return sample[1], sample[2]
+
+
+class TimedProbe(Probe):
+    """
+    Ask another probe for the current tab on a worker thread and wait at most `timeout`
+    seconds. ScriptingBridge can block for a long time while a browser is busy or shows
+    a modal dialog; a call missing its deadline counts as a stall and the last known
+    tab of the browser is used instead. No new call is made until the late one returns.
+    """
+
+    def __init__(self, probe, timeout):
+        self.probe = probe
+        self.timeout = timeout
+        # number of calls which missed their deadline
+        self.stalls = 0
+        # last known (title, url) per browser
+        self.tabs = {}
+        self.busy = False
+        self.requests = queue.Queue()
+        self.answers = queue.Queue()
+
+    def __enter__(self):
+        self.probe.__enter__()
+        worker = threading.Thread(target=self._work, name='trackmac-probe')
+        worker.daemon = True
+        worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.requests.put(None)
+        return self.probe.__exit__(exc_type, exc_val, exc_tb)
+
+    def _work(self):
+        while True:
+            browser_name = self.requests.get()
+            if browser_name is None:
+                return
+            try:
+                answer = self.probe.current_tab(browser_name)
+            except Exception as e:
+                answer = e
+            self.answers.put((browser_name, answer))
+
+    def _receive(self, block):
+        try:
+            browser_name, answer = self.answers.get(timeout=self.timeout) if block else self.answers.get_nowait()
+        except queue.Empty:
+            self.stalls += 1
+            return False
+        self.busy = False
+        if isinstance(answer, Exception):
+            raise answer
+        self.tabs[browser_name] = answer
+        return True
+
+    def frontmost_application(self):
+        return self.probe.frontmost_application()
+
+    def current_tab(self, browser_name):
+        # the answer of a call that missed its deadline may have come by now
+        if not self.busy or self._receive(block=False):
+            self.requests.put(browser_name)
+            self.busy = True
+            self._receive(block=True)
+        return self.tabs.get(browser_name, (None, None))
+
+
+class SystemClock(object):
+    """
+    Wall clock of the daemon
+    """
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def monotonic(self):
+        """
+        seconds for measuring intervals, never going backwards
+        """
+        return monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock(object):
+    """
+    Clock that moves forward only when the loop sleeps
+    """
+
+    def __init__(self, start=None):
+        self.start = start or datetime.datetime.now()
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self.elapsed += seconds
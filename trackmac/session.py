@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import datetime
+import collections
+
+import trackmac.utils
+from trackmac.metrics import timer
+from trackmac.models import db, NormalTrackRecord, WebTrackRecord, PageUrl, PageTitle, DailyUsage, TrackState, \
+    OPEN_RECORD_KEYS, LONGEST_RECORD_KEY
+
+
+class Interner(object):
+    """
+    Ids of the strings of a dictionary table, created on first sight.
+    The `size` most recently used ones are kept in memory.
+    """
+
+    def __init__(self, field, size=1024):
+        self.field = field
+        self.size = size
+        self.ids = collections.OrderedDict()
+
+    def __call__(self, value):
+        if value is None:
+            return None
+        try:
+            value_id = self.ids.pop(value)
+        except KeyError:
+            model = self.field.model
+            query = model.select(model.id).where(self.field == value)
+            value_id = query.scalar()
+            if value_id is None:
+                # another process, e.g. `tm merge`, may insert the same value meanwhile
+                model.insert({self.field: value}).on_conflict_ignore().execute()
+                value_id = query.scalar()
+            if len(self.ids) >= self.size:
+                self.ids.popitem(last=False)
+        self.ids[value] = value_id
+        return value_id
+
+    def clear(self):
+        """
+        forget all ids, e.g. when a rolled back transaction created some of them
+        """
+        self.ids.clear()
+
+
+class Session(object):
+    """
+    An application or browser tab session kept open in memory
+    """
+
+    def __init__(self, app_id, now, url=None, title=None):
+        self.app_id = app_id
+        self.url = url
+        self.title = title
+        self.domain = trackmac.utils.url_domain(url) if url else ''
+        self.start_datetime = now
+        self.end_datetime = now
+        # id of the persisted row, None until the session is flushed once
+        self.record_id = None
+        # seconds per day already added to DailyUsage
+        self.flushed = {}
+        self.dirty = True
+
+    @classmethod
+    def from_record(cls, rec):
+        """
+        reopen a persisted record
+        """
+        if isinstance(rec, WebTrackRecord):
+            session = cls(rec.app_id, rec.start_datetime, rec.url.url, rec.title and rec.title.title)
+        else:
+            session = cls(rec.app_id, rec.start_datetime)
+        session.end_datetime = rec.end_datetime
+        session.record_id = rec.id
+        session.flushed = dict(trackmac.utils.split_by_day(rec.start_datetime, rec.end_datetime, rec.duration))
+        session.dirty = False
+        return session
+
+    @property
+    def is_web(self):
+        return self.url is not None
+
+    @property
+    def model(self):
+        return WebTrackRecord if self.is_web else NormalTrackRecord
+
+    @property
+    def duration(self):
+        return max(int((self.end_datetime - self.start_datetime).total_seconds()), 1)
+
+    def matches(self, app_id, url):
+        return self.app_id == app_id and self.url == url
+
+    def extend(self, now, title=None):
+        self.end_datetime = now
+        if self.is_web:
+            # sometime web pages not loaded at start due to network lag
+            self.title = title
+        self.dirty = True
+
+    def save(self, urls, titles):
+        """
+        insert the session on its first flush and update it afterwards,
+        the seconds added since the last flush go to DailyUsage of the days they were spent on.
+        urls and titles are stored as ids given by the `Interner`s.
+        """
+        fields = {
+            'end_datetime': self.end_datetime,
+            'duration': self.duration,
+        }
+        if self.is_web:
+            fields['title'] = titles(self.title)
+        if self.record_id is None:
+            fields.update(app=self.app_id, start_datetime=self.start_datetime)
+            if self.is_web:
+                fields.update(url=urls(self.url), domain=self.domain)
+            self.record_id = self.model.insert(**fields).execute()
+        else:
+            self.model.update(**fields).where(self.model.id == self.record_id).execute()
+        flushed = dict(self.flushed)
+        for day, seconds in trackmac.utils.split_by_day(self.start_datetime, self.end_datetime, self.duration):
+            if seconds != flushed.get(day, 0):
+                DailyUsage.add(day, self.app_id, self.domain, seconds - flushed.get(day, 0))
+                flushed[day] = seconds
+        self.flushed = flushed
+        self.dirty = False
+
+
+class SessionBuffer(object):
+    """
+    Write-behind buffer for the sampling loop.
+
+    Ticks only extend the open session in memory. Closed sessions and the
+    open one are written in a single transaction when the session switches,
+    every `flush_interval` seconds and on shutdown, so a crash loses at most
+    one flush window.
+    """
+
+    def __init__(self, flush_interval, gap=1.5):
+        self.flush_interval = flush_interval
+        self.urls = Interner(PageUrl.url)
+        # trackmac.metrics.Metrics of the daemon, if enabled
+        self.metrics = None
+        self.titles = Interner(PageTitle.title)
+        # time delay or stopped for some time (1.5s is very inaccurate.)
+        self.gap = gap
+        self.current = None
+        self.closed = []
+        self.last_flush = None
+        # (state name, record id) last written to TrackState
+        self.pointer = None
+        # longest record state last seen, raised by the hour so a long session rarely writes it
+        self.longest = 0
+
+    def resume(self, now):
+        """
+        reopen the record left open by a previous run if it is recent enough
+        """
+        self.longest = TrackState.get_value(LONGEST_RECORD_KEY, 0)
+        for model, key in OPEN_RECORD_KEYS.items():
+            state = TrackState.get_or_none(TrackState.name == key)
+            rec = state and model.get_or_none(model.id == state.value)
+            if rec and (now - rec.end_datetime).total_seconds() <= self.gap:
+                self.current = Session.from_record(rec)
+                self.pointer = (key, rec.id)
+        if self.pointer is None:
+            TrackState.delete().where(TrackState.name << list(OPEN_RECORD_KEYS.values())).execute()
+
+    def track(self, now, app_id, url=None, title=None):
+        """
+        record one sample of the frontmost application or browser tab
+        """
+        cur = self.current
+        if cur is not None and cur.matches(app_id, url) and \
+                (now - cur.end_datetime).total_seconds() <= self.gap:
+            cur.extend(now, title)
+        else:
+            self.close()
+            self.current = Session(app_id, now, url, title)
+            self.flush(now)
+            return
+        if self.last_flush is None or (now - self.last_flush).total_seconds() >= self.flush_interval:
+            self.flush(now)
+
+    def forget(self, app_ids):
+        """
+        drop buffered sessions of applications not in `app_ids` any more, e.g. blocked ones
+        """
+        self.closed = [s for s in self.closed if s.app_id in app_ids]
+        if self.current is not None and self.current.app_id not in app_ids:
+            self.current = None
+        # another process may have pruned urls and titles as well
+        self.urls.clear()
+        self.titles.clear()
+
+    def close(self):
+        """
+        close the open session, it is written on the next flush
+        """
+        if self.current is not None:
+            self.closed.append(self.current)
+            self.current = None
+
+    def flush(self, now=None):
+        """
+        persist closed sessions and the open one in one transaction
+        """
+        if self.closed or (self.current is not None and self.current.dirty):
+            sessions = self.closed + ([self.current] if self.current is not None else [])
+            before = [(s.record_id, s.flushed) for s in sessions], self.pointer
+            longest = max(s.duration for s in sessions)
+            longest = self.longest if longest <= self.longest else -(-longest // 3600) * 3600
+            started = timer()
+            try:
+                with db.atomic():
+                    for session in sessions:
+                        session.save(self.urls, self.titles)
+                    if longest > self.longest:
+                        TrackState.maximize(LONGEST_RECORD_KEY, longest)
+                    self.save_pointer()
+            except Exception:
+                # the transaction was rolled back, so everything stays buffered for the next flush
+                for session, (record_id, flushed) in zip(sessions, before[0]):
+                    session.record_id, session.flushed, session.dirty = record_id, flushed, True
+                self.pointer = before[1]
+                self.urls.clear()
+                self.titles.clear()
+                raise
+            self.closed = []
+            self.longest = longest
+            if self.metrics:
+                self.metrics.count('flushes')
+                self.metrics.observe('flush_seconds', timer() - started)
+        self.last_flush = now or datetime.datetime.now()
+
+    def save_pointer(self):
+        """
+        point TrackState at the open record, only written when it changes
+        """
+        cur = self.current
+        pointer = cur and (OPEN_RECORD_KEYS[cur.model], cur.record_id)
+        if pointer == self.pointer:
+            return
+        TrackState.delete().where(TrackState.name << list(OPEN_RECORD_KEYS.values())).execute()
+        if pointer:
+            TrackState.insert(name=pointer[0], value=pointer[1]).execute()
+        self.pointer = pointer
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tag rules.
+
+A rule tags the applications or web sites whose name matches a glob, e.g.
+`*.youtube.com`, or a regular expression. Web sites are matched by their
+host without the scheme. A matching web site rule wins over the tag given
+to the application with `tm tag -a`, which wins over the application rules;
+among rules of the same kind the one added first wins.
+
+Reports group by the `tag_of` sql function backed by a TagMatcher. It
+compiles the rules once and remembers the tag of every distinct
+application and web site, so the rules run once per name, not per row.
+"""
+import re
+import fnmatch
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+KINDS = ('app', 'domain')
+
+
+def compile_pattern(pattern, regex=False):
+    """
+    case insensitive matcher of a glob or a regular expression, re.error if it is not valid
+    """
+    if regex:
+        return re.compile(pattern, re.IGNORECASE).search
+    return re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+
+
+def site(domain):
+    """
+    host of a web site as stored with the records, e.g. github.com of https://github.com/
+    """
+    return urlsplit(domain).netloc or domain
+
+
+class TagMatcher(object):
+    """
+    Tag of an application or web site by the rules, given as (tag_name, kind, pattern, regex) in order
+    """
+
+    def __init__(self, rules=()):
+        self.rules = dict((kind, []) for kind in KINDS)
+        for tag_name, kind, pattern, regex in rules:
+            self.rules[kind].append((compile_pattern(pattern, regex), tag_name))
+        # tag per (app_name, tag_name, domain) seen so far
+        self.tags = {}
+
+    def __bool__(self):
+        return any(self.rules.values())
+
+    __nonzero__ = __bool__
+
+    def __call__(self, app_name, tag_name, domain):
+        key = (app_name, tag_name, domain)
+        try:
+            return self.tags[key]
+        except KeyError:
+            pass
+        tag = self.first('domain', site(domain)) if domain else None
+        if tag is None:
+            tag = tag_name if tag_name is not None else self.first('app', app_name)
+        self.tags[key] = tag
+        return tag
+
+    def first(self, kind, name):
+        """
+        tag of the first rule of the kind matching the name
+        """
+        if name is None:
+            return None
+        for match, tag_name in self.rules[kind]:
+            if match(name):
+                return tag_name
+        return None
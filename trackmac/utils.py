@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import os
+import json
 import shutil
 import datetime
 from subprocess import Popen, PIPE
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 
 import trackmac.config
 
@@ -75,16 +80,13 @@ def remove_all_files():
 
 def create_database():
     """
-    create tables.
+    create tables or bring databases of older versions up to date.
     """
-    import peewee
-    import trackmac.models
+    import trackmac.migrations
     if not os.path.isfile(trackmac.config.TRACK_DB_FILE):
-        db = peewee.SqliteDatabase(trackmac.config.TRACK_DB_FILE)
-        db.create_tables(
-            [trackmac.models.Application, trackmac.models.NormalTrackRecord, trackmac.models.WebTrackRecord,
-             trackmac.models.BlockedApplication], safe=True)
         print('Creating database...')
+    for name in trackmac.migrations.migrate():
+        print('Applied migration {}'.format(name))
 
 
 def symlink_and_load_plist():
@@ -125,6 +127,106 @@ def get_start_date_for_period(period):
     return start_time
 
 
+def shift_months(value, months):
+    """
+    the same day and time `months` months later or earlier, the last day of the month if it is shorter
+    """
+    year, month = divmod(value.month - 1 + months, 12)
+    year += value.year
+    month += 1
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    return value.replace(year=year, month=month,
+                         day=min(value.day, (next_month - datetime.timedelta(days=1)).day))
+
+
+def url_domain(url):
+    """
+    scheme and host part of an url, e.g. https://github.com/
+    """
+    parts = urlsplit(url)
+    if not parts.netloc:
+        return url
+    return '{}://{}/'.format(parts.scheme, parts.netloc)
+
+
+def ndjson_line(columns, row):
+    """
+    one exported record as a line of json
+    """
+    return json.dumps(dict(zip(columns, row)), default=str, ensure_ascii=False) + '\n'
+
+
+def fts_query(words):
+    """
+    fts5 query matching documents containing all the words as prefixes, the query syntax is taken literally
+    """
+    return ' '.join(u'"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+def like_pattern(word):
+    """
+    LIKE pattern (with ESCAPE '\\') matching values containing the word
+    """
+    return u'%{}%'.format(word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+
+
+def as_datetime(value):
+    """
+    midnight of a date, datetimes are returned as they are
+    """
+    return datetime.datetime.combine(value, datetime.time()) if type(value) is datetime.date else value
+
+
+def split_range(start, end):
+    """
+    split [start, end) into the whole days it covers and the partial days at both edges.
+    return (first_day, last_day, edges), whole days are first_day <= day < last_day.
+    """
+    start, end = as_datetime(start), as_datetime(end)
+    first_day = start.date() if start.time() == datetime.time() else start.date() + datetime.timedelta(days=1)
+    last_day = end.date()
+    if first_day >= last_day:
+        return None, None, [(start, end)] if start < end else []
+    edges = []
+    first = datetime.datetime.combine(first_day, datetime.time())
+    last = datetime.datetime.combine(last_day, datetime.time())
+    if start < first:
+        edges.append((start, first))
+    if last < end:
+        edges.append((last, end))
+    return first_day, last_day, edges
+
+
+def seconds_before(start, end, duration, t):
+    """
+    seconds of a record from start to end spent before t. the seconds of [a, b) are
+    seconds_before(b) - seconds_before(a), so they always add up to the duration.
+    `trackmac.models.seconds_before` is the same in sql, both must stay in step.
+    """
+    if start >= t:
+        return 0
+    if end <= t:
+        return duration
+    return min(duration, max(0, int((t.replace(microsecond=0) - start.replace(microsecond=0)).total_seconds())))
+
+
+def split_by_day(start, end, duration):
+    """
+    seconds of a record per day as (day, seconds), days without any are left out
+    """
+    split = []
+    day = start.date()
+    before = 0
+    while day <= end.date():
+        midnight = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+        seconds = seconds_before(start, end, duration, midnight)
+        if seconds > before:
+            split.append((day, seconds - before))
+        before = seconds
+        day += datetime.timedelta(days=1)
+    return split
+
+
 def get_progress(iteration, total, prefix='', suffix='', barLength=30):
     """
     get progress bar for showing.